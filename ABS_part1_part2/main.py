@@ -12,8 +12,14 @@ from asset.houses import PrimaryHome, VacationHome
 from liability.tranche import StandardTranche
 from liability.securities import StructuredSecurities
 import os
+import sys
 import numpy_financial as npf
 import functools
+# The waterfall engine and its sinks are shared with part 3. Its folder is added after this one,
+# so that the loan and liability modules of this folder are still the ones used.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ABS_part3'))
+from waterfall.engine import runWaterfall
+from waterfall.sinks import CSVSink
 
 
 # This function loads the 1500 loans from Loans.csv and returns a LoanPool object containing the
@@ -58,57 +64,22 @@ def loadAssets():
     return LoanPool(loan_list)
 
 
-# This executes the ABS waterfall and calculates the waterfall metrics.
+# This executes the ABS waterfall and calculates the waterfall metrics. The waterfall is run by the
+# engine of part 3, whose CSVSink writes Assets.csv and Liabilities.csv at the current working
+# directory.
 def doWaterfall(loaded_pool, structured_deal):
-    # This sets the output files to locate at current working directory.
-    assets_file_path = os.path.join(os.getcwd(), "Assets.csv")
-    liabilities_file_path = os.path.join(os.getcwd(), "Liabilities.csv")
-    # This context manager creates the two output files and writes to them.
-    with open(assets_file_path, 'w') as afp, open(liabilities_file_path, 'w') as lfp:
-        # This writes the header for the asset-side output file.
-        afp.write('Period,Principal,Interest,Recoveries,Total,Balance,\n')
-        # This writes the first cell of the header for the liability-side output file.
-        lfp.write('Period,')
-        # This writes the rest of the header for the liability-side output file. Note that
-        # "tranche.subordination" is repeated many times because each piece of information needs
-        # to be labelled with the tranche to which the information pertains. Subordination takes
-        # on either "A" or "B".
-        for tranche in structured_deal:
-            lfp.write('{0} Interest Due,{1} Interest Paid,{2} Interest Shortfall,{3} Principal Due,'
-                      '{4} Principal Paid,{5} Principal Shortfall,{6} Balance,{7} Cash Flow,'
-                      .format(tranche.subordination, tranche.subordination, tranche.subordination,
-                              tranche.subordination, tranche.subordination, tranche.subordination,
-                              tranche.subordination, tranche.subordination))
-        # This writes the last cell of the header.
-        lfp.write('Cash Reserve\n')
-
-        # The period is initialized to 0.
-        period = 0
-        # This loop executes the waterfall and records the results to the output files. The loop
-        # continues as long as there is still cash flow from the assets.
-        while period == 0 or loaded_pool.totalMonthlyPmt(period) > 0:
-            # On the asset side, getWaterfall() returns principal due, interest due, recovery
-            # value, total monthly payment, and remaining balance.
-            asset_waterfall = loaded_pool.getWaterfall(period)
-            if period != 0:
-                # This increases the period on the liability side by 1.
-                structured_deal.increaseTimePeriodForAll()
-                # Making payments to the liabilities requires information about the interest
-                # payments and principal payments from the assets.
-                structured_deal.makePayments(asset_waterfall[1], asset_waterfall[0])
-            # On the liability side, getWaterfall() returns interest due, interest paid,
-            # interest shortfall, principal due, principal paid, principal shortfall, remaining
-            # balance, cash flow, and cash reserve.
-            liability_waterfall, cash_reserve = structured_deal.getWaterfall()
-            # Information contained in asset_waterfall is written to asset-side output file.
-            afp.write('{0},{1},\n'.format(period, ','.join(map(str, asset_waterfall))))
-            lfp.write('{},'.format(period))
-            # Information contained in liability_waterfall is written to liability-side file.
-            for tranche in liability_waterfall:
-                lfp.write('{},'.format(','.join(map(str, tranche))))
-            lfp.write('{},\n'.format(cash_reserve))
-            # One period is completed, and period is incremented.
-            period += 1
+    # This list holds the asset-side waterfall of each period. getWaterfall() returns principal
+    # due, interest due, recovery value, total monthly payment, and remaining balance.
+    asset_path = []
+    # The period is initialized to 0.
+    period = 0
+    # The loop continues as long as there is still cash flow from the assets.
+    while period == 0 or loaded_pool.totalMonthlyPmt(period) > 0:
+        asset_path.append(loaded_pool.getWaterfall(period))
+        # One period is completed, and period is incremented.
+        period += 1
+    # This pays the liabilities period by period and writes both sides to the output files.
+    runWaterfall(asset_path, structured_deal, CSVSink())
 
     # Now that the waterfall is completed, we can calculated pricing metrics.
     for tranche in structured_deal:
@@ -0,0 +1,85 @@
+'''
+This module contains the batchIRR function, which calculates the IRR of many cash flows at once.
+'''
+import numpy as np
+
+
+# This calculates the IRR of every row of cash_flows, a 2-D array with one row per cash flow and
+# one column per period. Rows of different lengths can be padded with zeros at the end. The cash
+# flows are expected to be conventional, i.e. an investment followed by returns, so that the NPV
+# falls as the rate rises and there is only one IRR.
+# All rows are solved together with Halley's method, starting from guess, which is either one
+# monthly rate for all rows or one per row, e.g. the tranches' coupons. Rows for which Halley's
+# method fails are solved by bisection instead. Rows without any IRR get nan.
+# This returns the monthly IRR and the annualized IRR (12 times the monthly IRR) as arrays.
+def batchIRR(cash_flows, guess=0.01, tol=10 ** -12, max_iter=50):
+    cash_flows = np.atleast_2d(np.asarray(cash_flows, dtype=float))
+    num_rows, num_periods = cash_flows.shape
+    periods = np.arange(num_periods)
+    rate = np.array(np.broadcast_to(np.asarray(guess, dtype=float), (num_rows,)))
+    # These keep track of the rows that are solved and the ones left for bisection.
+    converged = np.zeros(num_rows, dtype=bool)
+    failed = np.zeros(num_rows, dtype=bool)
+    for i in range(max_iter):
+        active = np.flatnonzero(~converged & ~failed)
+        if len(active) == 0:
+            break
+        r = rate[active, np.newaxis]
+        # Overflows only make the step not finite, in which case the row is left to bisection.
+        with np.errstate(all='ignore'):
+            # This calculates the NPV and its first two derivatives with respect to the rate.
+            discounted = _discount(cash_flows[active], r, periods)
+            npv = discounted.sum(axis=1)
+            d_npv = -(discounted * periods).sum(axis=1) / (1 + r[:, 0])
+            d2_npv = (discounted * periods * (periods + 1)).sum(axis=1) / (1 + r[:, 0]) ** 2
+            # Halley's step falls back to Newton's step when its denominator is 0.
+            denominator = 2 * d_npv ** 2 - npv * d2_npv
+            step = np.where(denominator != 0, 2 * npv * d_npv / denominator, npv / d_npv)
+        new_rate = rate[active] - step
+        # Steps that are not finite or go below -100% are left to bisection.
+        bad = ~np.isfinite(new_rate) | (new_rate <= -1)
+        failed[active[bad]] = True
+        good = active[~bad]
+        rate[good] = new_rate[~bad]
+        converged[good[np.abs(step[~bad]) <= tol * (1 + np.abs(rate[good]))]] = True
+    # The rows that have not converged are solved by bisection.
+    unsolved = np.flatnonzero(~converged)
+    if len(unsolved) > 0:
+        rate[unsolved] = _bisectIRR(cash_flows[unsolved], periods, tol)
+    return rate, rate * 12
+
+
+# This discounts every cash flow at its row's rate. Periods without cash flow stay 0 even if their
+# discount factor overflows.
+def _discount(cash_flows, rates, periods):
+    return np.where(cash_flows != 0, cash_flows * (1 + rates) ** -periods, 0.0)
+
+
+# This calculates the IRR of every row of cash_flows by bisection. The bracket goes from just above
+# -100% up to a rate at which the NPV is negative. Rows whose NPV does not change sign get nan.
+def _bisectIRR(cash_flows, periods, tol):
+    num_rows = len(cash_flows)
+
+    # This returns the NPV of every row at the given rates. Near -100%, it may be infinite.
+    def npv(rates):
+        with np.errstate(all='ignore'):
+            return _discount(cash_flows, rates[:, np.newaxis], periods).sum(axis=1)
+
+    low = np.full(num_rows, -1 + 10 ** -6)
+    high = np.ones(num_rows)
+    # The upper end of the bracket is raised until the NPV is negative.
+    for i in range(60):
+        raise_high = npv(high) > 0
+        if not raise_high.any():
+            break
+        high[raise_high] *= 2
+    npv_low = npv(low)
+    solvable = (npv_low > 0) & (npv(high) <= 0)
+    for i in range(200):
+        middle = (low + high) / 2
+        positive = npv(middle) > 0
+        low = np.where(positive, middle, low)
+        high = np.where(positive, high, middle)
+        if np.all(high - low <= tol * (1 + np.abs(low))):
+            break
+    return np.where(solvable, (low + high) / 2, np.nan)
@@ -2,6 +2,7 @@
 This module includes the StructuredSecurities class.
 '''
 from liability.tranche import Tranche
+import numpy as np
 import logging
 
 
@@ -10,7 +11,11 @@ class StructuredSecurities(object):
     # The constructor creates the data members for keeping track of the structured deal.
     def __init__(self):
         self._trancheList = []
-        self._percentNotionalDict = {}
+        # This holds the proportion of notional that belongs to each tranche, in the same order as
+        # _trancheList. It is useful for pro rata distribution of principal.
+        self._percentNotional = np.zeros(0)
+        # This is a lower triangular matrix of ones, which gives cumulative sums over the tranches.
+        self._cumulativeMatrix = np.zeros((0, 0))
         self._sequential = True
         self._period = 0
         self._cashReserve = 0
@@ -28,12 +33,10 @@ class StructuredSecurities(object):
         # This sorts the tranches by subordination. This is helpful since the waterfall must be
         # done according to tranches' subordination levels.
         self._trancheList.sort(key=lambda x: x.subordination)
-        # This calculates the total notional within the tranches.
-        total_notional = sum(tranche.notional for tranche in self._trancheList)
         # This records the proportion of notional that belongs to each tranche.
-        # It is useful for pro rata distribution of principal.
-        for tranche in self._trancheList:
-            self._percentNotionalDict[tranche.subordination] = tranche.notional / total_notional
+        notional = np.array([tranche.notional for tranche in self._trancheList], dtype=float)
+        self._percentNotional = notional / notional.sum()
+        self._cumulativeMatrix = np.tril(np.ones((len(notional), len(notional))))
 
     # This is the getter function for _sequential.
     @property
@@ -51,58 +54,149 @@ class StructuredSecurities(object):
         for tranche in self._trancheList:
             tranche.increaseTimePeriod()
 
-    # This contains the waterfall logic for payment distribution.
+    # This contains the waterfall logic for payment distribution. The amounts are allocated to all
+    # the tranches at once with array operations, and then recorded by each tranche.
     def makePayments(self, interest_available, principal_available):
         # First, we calculate the total cash available for distribution.
         cash_amount = interest_available + principal_available + self._cashReserve
 
-        # This loop is used for making interest payments.
-        for tranche in self._trancheList:
-            # This checks the amount of interest due for each tranche.
-            tranche_interest_due = tranche.getInterestDue()
-            # This pays the interest due if there is sufficient cash.
-            if cash_amount > tranche_interest_due:
-                tranche.makeInterestPayment(tranche_interest_due)
-                cash_amount -= tranche_interest_due
-            # If not, then it pays all the cash it has left.
-            else:
-                tranche.makeInterestPayment(cash_amount)
-                cash_amount = 0
-
-        # This loop is used for making principal payments.
-        for tranche in self._trancheList:
-            # This calculates principal due for when the mode of distribution is sequential.
-            if self._sequential:
-                tranche_principal_due = \
-                    min(tranche.balance[self._period - 1], principal_available +
-                        tranche.principalShortfall[self._period - 1])
-                principal_available -= tranche_principal_due
-            # This calculates principal due for when the mode of distribution is pro rata.
-            else:
-                tranche_principal_due = \
-                    min(tranche.balance[self._period - 1], principal_available *
-                        self._percentNotionalDict[tranche.subordination] +
-                        tranche.principalShortfall[self._period - 1])
-            # This tells each tranche its principal due.
+        # This pays the interest due of each tranche if there is sufficient cash, or else all the
+        # cash that is left.
+        interest_due = np.array([tranche.getInterestDue() for tranche in self._trancheList])
+        interest_paid, cash_amount = self._allocateCash(cash_amount, interest_due)
+        for tranche, interest_pmt in zip(self._trancheList, interest_paid.tolist()):
+            tranche.makeInterestPayment(interest_pmt)
+
+        # This pays the principal due in the same way.
+        balance = np.array([tranche.openingBalance() for tranche in self._trancheList])
+        principal_shortfall = np.array([tranche.openingPrincipalShortfall()
+                                        for tranche in self._trancheList])
+        principal_due = self._getPrincipalDue(principal_available, balance, principal_shortfall)
+        principal_paid, cash_amount = self._allocateCash(cash_amount, principal_due)
+        for tranche, tranche_principal_due, principal_pmt in zip(
+                self._trancheList, principal_due.tolist(), principal_paid.tolist()):
+            # This tells each tranche its principal due before paying it.
             tranche.setPrincipalDue(tranche_principal_due)
-            # This pays the principal due if there is sufficient cash.
-            if cash_amount > tranche_principal_due:
-                tranche.makePrincipalPayment(tranche_principal_due)
-                cash_amount -= tranche_principal_due
-            # If not, then it pays all the cash it has left.
-            else:
-                tranche.makePrincipalPayment(cash_amount)
-                cash_amount = 0
+            tranche.makePrincipalPayment(principal_pmt)
 
         # This informs user that cash has run out for the period.
         if cash_amount == 0:
             logging.debug('Cash has run out in period {}.'.format(self._period))
 
         # The remaining cash after each period is the new cash reserve.
-        self._cashReserve = cash_amount
+        self._cashReserve = float(cash_amount)
+
+    # This returns the principal due of each tranche, along the first axis, given the principal
+    # available along with the tranches' balances and principal shortfalls from the last period.
+    # In sequential mode, a tranche is due the lesser of its balance and the principal left by the
+    # tranches before it plus its shortfall. So the cumulative principal due is the cumulative
+    # balance, less the largest amount by which any tranche so far is short of it. In pro rata
+    # mode, each tranche is due its share of the principal available plus its shortfall, up to its
+    # balance.
+    def _getPrincipalDue(self, principal_available, balance, principal_shortfall):
+        if not self._sequential:
+            percent_notional = self._percentNotional.reshape((-1,) + (1,) * (balance.ndim - 1))
+            return np.minimum(balance, principal_available * percent_notional +
+                              principal_shortfall)
+        cumulative_balance = self._cumulativeSum(balance)
+        headroom = principal_available + principal_shortfall - cumulative_balance
+        # Without shortfalls, the headroom can only go down from one tranche to the next.
+        if principal_shortfall.any() or (balance < 0).any():
+            headroom = np.minimum.accumulate(headroom, axis=0)
+        cumulative_due = cumulative_balance + np.minimum(headroom, 0)
+        principal_due = cumulative_due.copy()
+        principal_due[1:] -= cumulative_due[:-1]
+        return principal_due
 
-    # This creates a list of lists that contains the waterfall results from each period.
+    # This allocates cash to amounts due in order along the first axis. Each amount is paid if
+    # there is sufficient cash, or else all the cash that is left. Since the cash left after each
+    # payment is the cash before it less the amount due, but never below 0, it equals the largest
+    # of the cash and the cumulative amounts due so far, less the cumulative amount due. This
+    # returns the amounts paid and the cash left after all of them.
+    def _allocateCash(self, cash_amount, amount_due):
+        cash_amount = np.asarray(cash_amount, dtype=float)
+        cumulative_due = self._cumulativeSum(amount_due)
+        # The largest cumulative amount due so far is the last one, unless some amounts are
+        # negative.
+        largest_due = cumulative_due
+        if (amount_due < 0).any():
+            largest_due = np.maximum.accumulate(cumulative_due, axis=0)
+        cash_left = np.maximum(largest_due, cash_amount) - cumulative_due
+        cash_before = np.concatenate((cash_amount[np.newaxis], cash_left[:-1]))
+        return np.minimum(amount_due, cash_before), cash_left[-1]
+
+    # This returns the cumulative sums over the tranches along the first axis. They are taken as
+    # a product with a lower triangular matrix of ones, which is much faster than cumsum() along
+    # an axis of only a few tranches.
+    def _cumulativeSum(self, values):
+        return self._cumulativeMatrix @ values
+
+    # This runs the same waterfall as makePayments() over many paths at once, with the paths along
+    # the first axis of the arrays. interest_available and principal_available hold the cash from
+    # the assets, with one row per path and one column per period starting from period 1. A path
+    # with fewer periods, as given by num_periods, pays nothing after its last period and its
+    # columns past that are ignored. The tranches themselves are not changed.
+    # This returns the cash flows as a 3-D array indexed by path, tranche and period, starting from
+    # period 0, which the IRRs need. The principal paid is not kept period by period; only the
+    # average life and the ending balance are returned, as arrays indexed by path and tranche. The
+    # tranches are in order of subordination.
+    def makeBatchPayments(self, interest_available, principal_available, num_periods=None):
+        interest_available = np.atleast_2d(np.asarray(interest_available, dtype=float))
+        principal_available = np.atleast_2d(np.asarray(principal_available, dtype=float))
+        num_paths, max_periods = interest_available.shape
+        if num_periods is None:
+            num_periods = np.full(num_paths, max_periods)
+        notional = np.array([tranche.notional for tranche in self._trancheList], dtype=float)
+        rate = np.array([tranche.rate for tranche in self._trancheList], dtype=float)
+        num_tranches = len(self._trancheList)
+        # This is the ledger of the cash flows, which is kept for every period. Inside the loop,
+        # the tranches run along the first axis and the paths along the second, so that the
+        # allocation across tranches goes row by row.
+        cash_flow = np.zeros((max_periods + 1, num_tranches, num_paths))
+        cash_flow[0] = -notional[:, np.newaxis]
+        # This is the running sum of each period times the principal paid in it, which is the
+        # average life once divided by the notional.
+        weighted_principal = np.zeros((num_tranches, num_paths))
+        # These hold the state of every path at the end of the last period.
+        balance = np.repeat(notional[:, np.newaxis], num_paths, axis=1)
+        interest_shortfall = np.zeros((num_tranches, num_paths))
+        principal_shortfall = np.zeros((num_tranches, num_paths))
+        cash_reserve = np.zeros(num_paths)
+        rate = rate[:, np.newaxis]
+        for period in range(1, max_periods + 1):
+            # These are the paths that still receive cash from the assets in this period.
+            active = period <= num_periods
+            cash_amount = (interest_available[:, period - 1] + principal_available[:, period - 1] +
+                           cash_reserve)
+            # This pays the interest due, or all the cash that is left if it is not enough.
+            interest_due = balance * rate / 12 + interest_shortfall
+            interest_paid, cash_amount = self._allocateCash(cash_amount, interest_due)
+            # This pays the principal due in the same way.
+            principal_due = self._getPrincipalDue(principal_available[:, period - 1], balance,
+                                                  principal_shortfall)
+            paid, cash_amount = self._allocateCash(cash_amount, principal_due)
+            # The remaining balance is set to 0 below the same threshold as in the tranches.
+            remaining = balance - paid
+            remaining = np.where(np.abs(remaining) > 10 ** -6, remaining, 0.0)
+            # Nothing is paid on the paths that have run out of periods.
+            paid = np.where(active, paid, 0.0)
+            weighted_principal += period * paid
+            cash_flow[period] = np.where(active, interest_paid + paid, 0.0)
+            # The paths that have run out of periods keep their state.
+            balance = np.where(active, remaining, balance)
+            interest_shortfall = np.where(active, interest_due - interest_paid, interest_shortfall)
+            principal_shortfall = np.where(active, principal_due - paid, principal_shortfall)
+            cash_reserve = np.where(active, cash_amount, cash_reserve)
+        return cash_flow.transpose(2, 1, 0), (weighted_principal / notional[:, np.newaxis]).T, \
+            balance.T
+
+    # This creates a list of lists that contains the waterfall results from each period. Nothing is
+    # due or paid in period 0, so each tranche only has its notional then.
     def getWaterfall(self):
+        if self._period == 0:
+            res = [[0, 0, 0, 0, 0, 0, tranche.notional, -tranche.notional]
+                   for tranche in self._trancheList]
+            return res, self._cashReserve
         res = [[tranche.interestDue[self._period],
                 tranche.interestPaid[self._period],
                 tranche.interestShortfall[self._period],
@@ -128,3 +222,4 @@ class StructuredSecurities(object):
         for tranche in self._trancheList:
             tranche.reset()
         logging.debug('The tranches have been reset.')
+
@@ -0,0 +1,55 @@
+'''
+This module checks batchIRR against numpy_financial.irr, one cash flow at a time. It is run with
+python -m pytest from the ABS_part3 folder.
+'''
+from liability.irr import batchIRR
+import numpy as np
+import numpy_financial as npf
+
+
+# This returns num_rows conventional cash flows of up to num_periods periods after period 0, padded
+# with zeros at the end, along with the number of periods of each. Each one starts with the notional
+# and is followed by payments that add up to between 60% and 160% of it, so that some IRRs are
+# negative.
+def makeCashFlows(rng, num_rows, num_periods):
+    lengths = rng.integers(1, num_periods + 1, num_rows)
+    cash_flows = np.zeros((num_rows, num_periods + 1))
+    for i, length in enumerate(lengths):
+        notional = rng.uniform(10 ** 5, 10 ** 7)
+        payments = rng.uniform(0, 1, length)
+        cash_flows[i, 0] = -notional
+        cash_flows[i, 1:length + 1] = payments / payments.sum() * notional * rng.uniform(0.6, 1.6)
+    return cash_flows, lengths
+
+
+# This checks that batchIRR solves every row as numpy_financial.irr does, whether it starts from one
+# guess for all rows or from one per row.
+def testBatchIRRMatchesNumpyFinancial():
+    rng = np.random.default_rng(18)
+    cash_flows, lengths = makeCashFlows(rng, 200, 72)
+    expected = np.array([npf.irr(row[:length + 1]) for row, length in zip(cash_flows, lengths)])
+    for guess in (0.01, rng.uniform(0, 0.02, len(cash_flows))):
+        monthly_IRR, annual_IRR = batchIRR(cash_flows, guess)
+        assert np.allclose(monthly_IRR, expected, rtol=10 ** -10, atol=10 ** -12)
+        assert np.allclose(annual_IRR, monthly_IRR * 12, rtol=0, atol=0)
+
+
+# This checks the bisection that solves the rows for which Halley's method fails. Without any of
+# Halley's iterations, every row is solved by bisection.
+def testBatchIRRBisection():
+    rng = np.random.default_rng(18)
+    cash_flows, lengths = makeCashFlows(rng, 50, 72)
+    expected = np.array([npf.irr(row[:length + 1]) for row, length in zip(cash_flows, lengths)])
+    monthly_IRR, annual_IRR = batchIRR(cash_flows, max_iter=0)
+    assert np.allclose(monthly_IRR, expected, rtol=10 ** -10, atol=10 ** -12)
+
+
+# This checks that the rows without any IRR, whose cash flows never change sign, get nan, also when
+# none of the rows has an IRR.
+def testBatchIRRWithoutIRR():
+    cash_flows = np.array([[-100.0, 0, 0], [-100.0, -5, 0], [-100.0, 50, 60]])
+    monthly_IRR, annual_IRR = batchIRR(cash_flows, 0.01)
+    assert np.isnan(monthly_IRR[:2]).all() and np.isnan(annual_IRR[:2]).all()
+    assert np.isclose(monthly_IRR[2], npf.irr(cash_flows[2]), rtol=10 ** -10)
+    monthly_IRR, annual_IRR = batchIRR(cash_flows[:2], 0.01)
+    assert np.isnan(monthly_IRR).all() and np.isnan(annual_IRR).all()
@@ -0,0 +1,166 @@
+'''
+This module checks the waterfall of StructuredSecurities over many paths at once against the
+waterfall of one path at a time. It is run with python -m pytest from the ABS_part3 folder.
+'''
+from liability.tranche import StandardTranche
+from liability.securities import StructuredSecurities
+import numpy as np
+
+
+# This returns a structured deal of three tranches with a total notional of 10 ** 6.
+def makeDeal(sequential):
+    structured_deal = StructuredSecurities()
+    structured_deal.addTranche(StandardTranche(6 * 10 ** 5, 0.05, 'A'),
+                               StandardTranche(3 * 10 ** 5, 0.08, 'B'),
+                               StandardTranche(10 ** 5, 0.12, 'C'))
+    structured_deal.sequential = sequential
+    return structured_deal
+
+
+# This returns the interest and principal available on num_paths paths of up to num_periods
+# periods, along with the number of periods of each path. The cash is sometimes short and sometimes
+# missing altogether, so that the tranches build up shortfalls and then catch up on them.
+def makeAvailableCash(rng, num_paths, num_periods):
+    lengths = rng.integers(1, num_periods + 1, num_paths)
+    principal_available = rng.uniform(0, 2 * 10 ** 6 / num_periods, (num_paths, num_periods))
+    interest_available = rng.uniform(0, 8000, (num_paths, num_periods))
+    missing = rng.uniform(size=(num_paths, num_periods)) < 0.2
+    principal_available[missing] = 0
+    interest_available[missing] = 0
+    return interest_available, principal_available, lengths
+
+
+# This checks that makeBatchPayments() pays every path as makePayments() does, one period at a time,
+# in both sequential and pro rata mode, and leaves the tranches as they were.
+def testBatchPaymentsMatchPaymentsOfEachPath():
+    rng = np.random.default_rng(22)
+    interest_available, principal_available, lengths = makeAvailableCash(rng, 40, 60)
+    for sequential in (True, False):
+        structured_deal = makeDeal(sequential)
+        cash_flows, average_life, balance = structured_deal.makeBatchPayments(
+            interest_available, principal_available, lengths)
+        assert cash_flows.shape == (40, 3, 61)
+        assert average_life.shape == balance.shape == (40, 3)
+        for i, length in enumerate(lengths):
+            for period in range(1, length + 1):
+                structured_deal.increaseTimePeriodForAll()
+                structured_deal.makePayments(interest_available[i, period - 1],
+                                             principal_available[i, period - 1])
+            for j, tranche in enumerate(structured_deal):
+                assert np.allclose(cash_flows[i, j, :length + 1], tranche.cashFlow,
+                                   rtol=10 ** -12, atol=10 ** -6)
+                # The average life is checked even when the tranche is not paid off.
+                assert np.isclose(average_life[i, j], np.dot(np.arange(length + 1),
+                                                             tranche.principalPaid) /
+                                  tranche.notional, rtol=10 ** -12, atol=10 ** -9)
+                assert np.isclose(balance[i, j], tranche.notionalBalance(), rtol=10 ** -12,
+                                  atol=10 ** -6)
+                # Nothing is paid after the last period of the path.
+                assert not cash_flows[i, j, length + 1:].any()
+            structured_deal.resetAll()
+        assert [tranche.cashFlow.tolist() for tranche in structured_deal] == [
+            [-tranche.notional] for tranche in structured_deal]
+
+
+# This checks that a single path can be given as 1-D arrays, and that all of its periods are paid
+# when the number of periods is not given.
+def testBatchPaymentsOfOnePath():
+    rng = np.random.default_rng(22)
+    interest_available, principal_available, lengths = makeAvailableCash(rng, 1, 30)
+    structured_deal = makeDeal(True)
+    cash_flows, average_life, balance = structured_deal.makeBatchPayments(
+        interest_available[0], principal_available[0])
+    for period in range(1, 31):
+        structured_deal.increaseTimePeriodForAll()
+        structured_deal.makePayments(interest_available[0, period - 1],
+                                     principal_available[0, period - 1])
+    assert np.allclose(cash_flows[0], [tranche.cashFlow for tranche in structured_deal],
+                       rtol=10 ** -12, atol=10 ** -6)
+
+
+# This pays the amounts due one after the other with the cash, as the loop over the tranches in
+# makePayments() used to, and returns the amounts paid and the cash left.
+def allocateCashByLoop(cash_amount, amount_due):
+    amount_paid = []
+    for tranche_amount_due in amount_due:
+        if cash_amount > tranche_amount_due:
+            amount_paid.append(tranche_amount_due)
+            cash_amount -= tranche_amount_due
+        else:
+            amount_paid.append(cash_amount)
+            cash_amount = 0
+    return amount_paid, cash_amount
+
+
+# This returns the principal due of each tranche, as the loop over the tranches in makePayments()
+# used to.
+def getPrincipalDueByLoop(principal_available, balance, principal_shortfall, percent_notional,
+                          sequential):
+    principal_due = []
+    for tranche_balance, tranche_shortfall, tranche_percent in zip(balance, principal_shortfall,
+                                                                    percent_notional):
+        if sequential:
+            tranche_principal_due = min(tranche_balance, principal_available + tranche_shortfall)
+            principal_available -= tranche_principal_due
+        else:
+            tranche_principal_due = min(tranche_balance, principal_available * tranche_percent +
+                                        tranche_shortfall)
+        principal_due.append(tranche_principal_due)
+    return principal_due
+
+
+# This returns a structured deal of num_tranches tranches of random notionals.
+def makeDeepDeal(rng, num_tranches):
+    structured_deal = StructuredSecurities()
+    structured_deal.addTranche(*[StandardTranche(rng.uniform(10 ** 4, 10 ** 6), 0.05, i)
+                                 for i in range(num_tranches)])
+    return structured_deal
+
+
+# This checks that _allocateCash() pays a deal of 12 tranches as the loop does, with enough cash
+# for all, some or none of the amounts due, and with some negative amounts due. It also checks that
+# the paths can run along a second axis.
+def testAllocateCashMatchesLoop():
+    rng = np.random.default_rng(23)
+    structured_deal = makeDeepDeal(rng, 12)
+    amount_due = rng.uniform(0, 10 ** 5, (12, 200))
+    amount_due[rng.uniform(size=amount_due.shape) < 0.1] *= -0.1
+    cash_amount = rng.uniform(0, 1.2, 200) * amount_due.sum(axis=0)
+    cash_amount[:10] = 0
+    amount_paid, cash_left = structured_deal._allocateCash(cash_amount, amount_due)
+    for i in range(200):
+        expected_paid, expected_left = allocateCashByLoop(cash_amount[i], amount_due[:, i])
+        single_paid, single_left = structured_deal._allocateCash(cash_amount[i], amount_due[:, i])
+        assert np.allclose(amount_paid[:, i], expected_paid, rtol=10 ** -12, atol=10 ** -6)
+        assert np.isclose(cash_left[i], expected_left, rtol=10 ** -12, atol=10 ** -6)
+        assert np.allclose(single_paid, amount_paid[:, i], rtol=10 ** -12, atol=10 ** -6)
+        assert np.isclose(single_left, cash_left[i], rtol=10 ** -12, atol=10 ** -6)
+
+
+# This checks that _getPrincipalDue() gives the principal due of a deal of 12 tranches as the loop
+# does, in both sequential and pro rata mode, with and without principal shortfalls, and with
+# tranches that are paid off or overpaid.
+def testPrincipalDueMatchesLoop():
+    rng = np.random.default_rng(23)
+    structured_deal = makeDeepDeal(rng, 12)
+    percent_notional = [tranche.notional for tranche in structured_deal]
+    percent_notional = np.array(percent_notional) / sum(percent_notional)
+    balance = rng.uniform(0, 10 ** 6, (12, 200))
+    balance[rng.uniform(size=balance.shape) < 0.2] = 0
+    balance[rng.uniform(size=balance.shape) < 0.05] = -100
+    principal_available = rng.uniform(0, 3 * 10 ** 6, 200)
+    principal_shortfall = np.where(rng.uniform(size=balance.shape) < 0.3,
+                                   rng.uniform(0, 10 ** 5, balance.shape), 0)
+    # Without shortfalls or overpaid tranches, the principal due is calculated in a shorter way.
+    for test_balance, test_shortfall in ((np.maximum(balance, 0), np.zeros((12, 200))),
+                                         (balance, np.zeros((12, 200))),
+                                         (balance, principal_shortfall)):
+        for sequential in (True, False):
+            structured_deal.sequential = sequential
+            principal_due = structured_deal._getPrincipalDue(principal_available, test_balance,
+                                                             test_shortfall)
+            for i in range(200):
+                expected = getPrincipalDueByLoop(principal_available[i], test_balance[:, i],
+                                                 test_shortfall[:, i], percent_notional,
+                                                 sequential)
+                assert np.allclose(principal_due[:, i], expected, rtol=10 ** -12, atol=10 ** -6)
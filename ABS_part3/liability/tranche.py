@@ -1,6 +1,8 @@
 '''
 This module includes the Tranche base class and the StandardTranche derived class.
 '''
+import numpy as np
+import logging
 
 
 # This is the tranche base class, from which StandardTranche is derived.
@@ -43,118 +45,156 @@ class Tranche(object):
 
 
 # This is the StandardTranche class, from which investors receive both interest and principal.
+# Its ledgers are the rows of a numpy array, with one column per period. The array is preallocated
+# for horizon periods after period 0 and is reused by every simulation, so resetting only rewinds
+# the period. It is doubled if a deal runs past its end.
 class StandardTranche(Tranche):
-    def __init__(self, notional, rate, subordination):
+    # These are the rows of the ledger array.
+    _ledgerRows = ('interestDue', 'interestPaid', 'interestShortfall', 'principalDue',
+                   'principalPaid', 'principalShortfall', 'balance', 'cashFlow')
+
+    def __init__(self, notional, rate, subordination, horizon=360):
         # This calls for the base class constructor.
         super(StandardTranche, self).__init__(notional, rate, subordination)
+        self._period = 0
+        self._setLedger(np.zeros((len(self._ledgerRows), horizon + 1)))
         # This calls for reset(), which sets the other data members.
         self.reset()
 
+    # This sets the ledger array. Each ledger is kept as a view of its row as well, so that a single
+    # period can be read or written without going through the whole array.
+    def _setLedger(self, ledger):
+        self._ledger = ledger
+        (self._interestDue, self._interestPaid, self._interestShortfall, self._principalDue,
+         self._principalPaid, self._principalShortfall, self._balance, self._cashFlow) = ledger
+
     # reset() may be called by StandardTranche's constructor or by StructuredSecurities when
-    # resetting a tranche.
+    # resetting a tranche. The periods used by the last simulation are cleared, so that a period
+    # only holds a value once it has been recorded.
     def reset(self):
+        self._ledger[:, :self._period + 1] = 0
         self._period = 0
-        self._interestDue = [0]
-        self._interestPaid = [0]
-        self._interestShortfall = [0]
-        self._principalDue = [0]
-        self._principalPaid = [0]
-        self._principalShortfall = [0]
-        self._balance = [self._notional]
-        self._cashFlow = [-self._notional]
-
+        # These are the last periods in which interest and principal were paid. Nothing can be
+        # paid in period 0, so it counts as paid.
+        self._interestPaidPeriod = 0
+        self._principalPaidPeriod = 0
+        self._balance[0] = self._notional
+        self._cashFlow[0] = -self._notional
+
+    # The getter functions below return views of the ledgers from period 0 to the current period.
+    # The views are only valid until the tranche is reset.
     # This is the getter function for _interestDue.
     @property
     def interestDue(self):
-        return self._interestDue
+        return self._interestDue[:self._period + 1]
     
     # This is the getter function for _interestPaid.
     @property
     def interestPaid(self):
-        return self._interestPaid
+        return self._interestPaid[:self._period + 1]
 
     # This is the getter function for _interestShortfall.
     @property
     def interestShortfall(self):
-        return self._interestShortfall
+        return self._interestShortfall[:self._period + 1]
         
     # This is the getter function for _principalDue.
     @property
     def principalDue(self):
-        return self._principalDue
+        return self._principalDue[:self._period + 1]
     
     # This is the getter function for _principalPaid.
     @property
     def principalPaid(self):
-        return self._principalPaid
+        return self._principalPaid[:self._period + 1]
     
     # This is the getter function for _principalShortfall.
     @property
     def principalShortfall(self):
-        return self._principalShortfall
+        return self._principalShortfall[:self._period + 1]
     
     # This is the getter function for _balance.
     @property
     def balance(self):
-        return self._balance
+        return self._balance[:self._period + 1]
     
     # This is the getter function for _cashFlow.
     @property
     def cashFlow(self):
-        return self._cashFlow
+        return self._cashFlow[:self._period + 1]
 
-    # This increases period by 1.
+    # This increases period by 1. If the ledgers are full, they are doubled in length.
     def increaseTimePeriod(self):
         self._period += 1
+        if self._period == self._ledger.shape[1]:
+            self._setLedger(np.concatenate((self._ledger, np.zeros_like(self._ledger)), axis=1))
+            logging.debug('The ledgers have been extended to {0} periods.'.format(
+                self._ledger.shape[1]))
 
     # This returns the amount of interest that is due in current period.
     def getInterestDue(self):
-        self._interestDue.append(self._balance[self._period - 1] * self._rate / 12 +
-                                 self._interestShortfall[self._period - 1])
+        self._interestDue[self._period] = (self._balance[self._period - 1] * self._rate / 12 +
+                                           self._interestShortfall[self._period - 1])
         return self._interestDue[self._period]
 
     # This takes the interest payment and records interest shortfall.
     def makeInterestPayment(self, interest_pmt):
-        if self._period in self._interestPaid:
+        if self._interestPaidPeriod == self._period:
             raise IndexError('Interest payment has already been made.')
         elif self._balance[self._period - 1] == 0 and interest_pmt != 0:
             raise ValueError('Tranche is fully paid off. It should not receive interest payment.')
         else:
             # This records the interest payment.
-            self._interestPaid.append(interest_pmt)
+            self._interestPaid[self._period] = interest_pmt
+            self._interestPaidPeriod = self._period
             # This records any interest shortfall.
-            self._interestShortfall.append(self._interestDue[self._period] - interest_pmt)
+            self._interestShortfall[self._period] = self._interestDue[self._period] - interest_pmt
 
     # Since principal due is partly determined by the amount of principal received from loans,
     # the amount is given by StructuredSecurities instead of calculated here.
     def setPrincipalDue(self, tranche_principal_due):
-        self._principalDue.append(tranche_principal_due)
+        self._principalDue[self._period] = tranche_principal_due
 
     # This takes the principal payment and records principal shortfall, remaining balance,
     # and total periodic cash flow.
     def makePrincipalPayment(self, principal_pmt):
-        if self._period in self._principalPaid:
+        if self._principalPaidPeriod == self._period:
             raise IndexError('Principal payment has already been made.')
         elif self._balance[self._period - 1] == 0 and principal_pmt != 0:
             raise ValueError('Tranche is fully paid off. It should not receive principal payment.')
         else:
             # This records the principal payment.
-            self._principalPaid.append(principal_pmt)
+            self._principalPaid[self._period] = principal_pmt
+            self._principalPaidPeriod = self._period
             # This records any principal shortfall.
-            self._principalShortfall.append(self._principalDue[self._period] - principal_pmt)
+            self._principalShortfall[self._period] = \
+                self._principalDue[self._period] - principal_pmt
             # This calculates and records remaining balance.
-            b0 = self._balance[self._period - 1] - self._principalPaid[self._period]
-            if abs(b0) > 10 ** -6:
-                self._balance.append(b0)
+            b0 = self._balance[self._period - 1] - principal_pmt
             # If the remaining balance is less than a certain threshold, it is simply set to 0.
             # This avoids AL becoming infinity due to rounding errors in balance.
-            else:
-                self._balance.append(0)
+            self._balance[self._period] = b0 if abs(b0) > 10 ** -6 else 0
             # This calculates total periodic cash flow, which is simply the sum of interest paid
             # and principal paid.
-            self._cashFlow.append(self._interestPaid[self._period] +
-                                  self._principalPaid[self._period])
+            self._cashFlow[self._period] = self._interestPaid[self._period] + principal_pmt
 
     # This returns the remaining notional balance.
     def notionalBalance(self):
         return self._balance[self._period]
+
+    # This returns the balance at the start of the current period.
+    def openingBalance(self):
+        return self._balance[self._period - 1]
+
+    # This returns the principal shortfall carried into the current period.
+    def openingPrincipalShortfall(self):
+        return self._principalShortfall[self._period - 1]
+
+    # This returns the AL of the tranche, which is the sum of the principal payments weighted by
+    # their periods, divided by the notional. If the tranche is not completely paid off, AL is
+    # infinite, so None is returned instead.
+    def averageLife(self):
+        if self.notionalBalance() > 0:
+            return None
+        principal_paid = self.principalPaid
+        return np.dot(np.arange(len(principal_paid)), principal_paid) / self._notional
@@ -0,0 +1,395 @@
+'''
+This module includes the ArrayLoanPool class, which stores a pool of loans as numpy columns
+instead of a list of loan objects. It has the same public interface as LoanPool.
+'''
+from loan.loan_base import Loan
+from loan.mortgage_mixin import MortgageMixin
+from loan.pool_mixin import PoolMixin
+from loan.loans import VariableRateLoan
+from asset.asset_base import Asset
+from multiprocessing import shared_memory
+import numpy as np
+import logging
+
+
+# This is the ArrayLoanPool class. Each attribute of the loans is kept in one contiguous array, so
+# every aggregate over the pool is a single vectorized reduction.
+class ArrayLoanPool(PoolMixin):
+    # This dict provides the conversion between the "Loan Type" as entered in the Loans.csv and
+    # the code stored in the loan type column.
+    _loanTypeCodes = {'Auto Loan': 0, 'Fixed Rate Mortgage': 1, 'Variable Rate Mortgage': 2}
+    # These are the columns that stay the same throughout the simulations. They are the ones that
+    # can be placed in shared memory.
+    _staticColumns = ('_face', '_rate', '_term', '_assetValue', '_deprRate', '_monthlyRate',
+                      '_payment', '_monthlyDeprRate', '_maturity', '_loanType', '_isMortgage')
+
+    # The class requires one array per loan attribute to initialize. depr_rate is the annual
+    # depreciation rate of each loan's asset. loan_type holds either the codes in _loanTypeCodes
+    # or the loan type names as entered in the Loans.csv.
+    def __init__(self, face, rate, term, asset_value, depr_rate, loan_type):
+        self._face = np.ascontiguousarray(face, dtype=float)
+        self._rate = np.ascontiguousarray(rate, dtype=float)
+        self._term = np.ascontiguousarray(term, dtype=float)
+        self._assetValue = np.ascontiguousarray(asset_value, dtype=float)
+        self._deprRate = np.ascontiguousarray(depr_rate, dtype=float)
+        self._loanType = np.ascontiguousarray(
+            [self._loanTypeCodes.get(code, code) for code in loan_type], dtype=np.int8)
+        # This keeps track of the period in which each loan defaults. np.inf means no default.
+        self._defaultPeriod = np.full(len(self._face), np.inf)
+        # These are derived columns that stay the same throughout the simulations.
+        self._monthlyRate = self._rate / 12
+        self._payment = self._monthlyRate * self._face / \
+            (1 - (1 + self._monthlyRate) ** (-self._term))
+        self._monthlyDeprRate = Asset.getMonthlyDeprRate(self._deprRate)
+        self._isMortgage = self._loanType != self._loanTypeCodes['Auto Loan']
+        # A loan stops being active, and can no longer default, in the first whole period at or
+        # after its term.
+        self._maturity = np.ceil(self._term)
+        # This holds the probability of default for every period in which a loan can default.
+        self._defaultProbCurve = Loan.defaultProbabilityCurve(int(self._maturity.max()))
+        # These hold the probability of defaulting in or before every period, and each loan's
+        # probability of defaulting by its maturity.
+        self._cumDefaultProb = Loan.cumulativeDefaultProbabilities(int(self._maturity.max()))
+        self._maturityDefaultProb = self._cumDefaultProb[self._maturity.clip(min=0).astype(int)]
+        # Defaults are either checked period by period ('period') or sampled for the whole
+        # simulation in period 0 ('time').
+        self._defaultSampling = 'period'
+        # The number of defaults can be tilted, so that its expected value is raised by this many
+        # standard deviations. With a tilt other than 0, likelihoodRatio() gives the weight of each
+        # simulation. _defaultTwist is the corresponding twist (see Loan.defaultCountTwist()).
+        self._defaultTilt = 0.0
+        self._defaultTwist = 0.0
+        self._twistedDefaultProb = None
+        self._logTwistFactor = 0.0
+        # This holds the asset-side waterfall of every period when no loan defaults.
+        self._baseline = None
+        # This holds the expected loss of the pool once it has been calculated.
+        self._expectedLoss = None
+        # This holds the shared memory block of the static columns, if they have been shared, and
+        # the name, type, shape, and position of each column within the block.
+        self._sharedMemory = None
+        self._sharedLayout = None
+
+    # This creates an ArrayLoanPool from a list of loan objects.
+    @classmethod
+    def fromLoans(cls, loan_list):
+        loan_type = [(2 if isinstance(loan, VariableRateLoan) else 1)
+                     if isinstance(loan, MortgageMixin) else 0 for loan in loan_list]
+        # Variable rate loans are stored with the rate of their first period.
+        return cls([loan.face for loan in loan_list],
+                   [loan.rate(1) for loan in loan_list],
+                   [loan.term for loan in loan_list],
+                   [loan.asset.initialVal for loan in loan_list],
+                   [loan.asset.annualDeprRate() for loan in loan_list],
+                   loan_type)
+
+    # This moves the static columns into one shared memory block. When the pool is then sent to
+    # another process, only the name of the block is pickled, and the other process attaches to
+    # the same memory read-only. Default periods stay private to each process.
+    def shareStaticColumns(self):
+        if self._sharedMemory is not None:
+            return
+        # Each column starts at a multiple of 8 bytes.
+        offsets = []
+        size = 0
+        for column in self._staticColumns:
+            offsets.append(size)
+            size += -(-getattr(self, column).nbytes // 8) * 8
+        self._sharedMemory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self._sharedLayout = []
+        for column, offset in zip(self._staticColumns, offsets):
+            values = getattr(self, column)
+            shared_values = np.ndarray(values.shape, values.dtype, self._sharedMemory.buf, offset)
+            shared_values[:] = values
+            shared_values.flags.writeable = False
+            setattr(self, column, shared_values)
+            self._sharedLayout.append((column, values.dtype.str, values.shape, offset))
+        logging.debug('{0} bytes of loan data moved into shared memory.'.format(size))
+
+    # This frees the shared memory block. It should be called by the process that shared the
+    # columns once no other process needs them. The columns are copied back into private memory.
+    def releaseSharedMemory(self):
+        if self._sharedMemory is None:
+            return
+        for column in self._staticColumns:
+            setattr(self, column, np.array(getattr(self, column)))
+        self._sharedMemory.close()
+        self._sharedMemory.unlink()
+        self._sharedMemory = None
+        self._sharedLayout = None
+
+    # This is called when the pool is pickled. Shared columns are replaced by the name of their
+    # shared memory block.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._sharedMemory is not None:
+            for column in self._staticColumns:
+                del state[column]
+            state['_sharedMemory'] = self._sharedMemory.name
+        return state
+
+    # This is called when the pool is unpickled. It attaches to the shared memory block, if any.
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._sharedMemory is not None:
+            self._sharedMemory = shared_memory.SharedMemory(name=self._sharedMemory)
+            for column, dtype, shape, offset in self._sharedLayout:
+                shared_values = np.ndarray(shape, dtype, self._sharedMemory.buf, offset)
+                shared_values.flags.writeable = False
+                setattr(self, column, shared_values)
+
+    # This returns the number of loans in the pool.
+    def __len__(self):
+        return len(self._face)
+
+    # This converts the class into an iterable class. Since there are no loan objects, the
+    # generator returns the index of each loan within the columns.
+    def __iter__(self):
+        for i in range(len(self._face)):
+            yield i
+
+    # This returns the remaining balance of every loan, ignoring default.
+    def _scheduledBalance(self, period):
+        growth = (1 + self._monthlyRate) ** period
+        balance = self._face * growth - self._payment * (growth - 1) / self._monthlyRate
+        # Balance is 0 from the end of the term onwards.
+        return np.where(period < self._term, balance, 0.0)
+
+    # This returns the balance of every loan for a given period.
+    def _balance(self, period):
+        return np.where(self._defaultPeriod <= period, 0.0, self._scheduledBalance(period))
+
+    # This returns the PMI of every loan. Only mortgages with a balance greater than 80% of the
+    # asset value pay PMI.
+    def _PMI(self, balance):
+        return np.where(self._isMortgage & (balance > self._assetValue * 0.8),
+                        0.0075 / 12 * self._assetValue, 0.0)
+
+    # This returns the principal due, interest due, recovery value, and remaining balance of every
+    # loan for a given period. Each is an array with one entry per loan.
+    def _periodFlows(self, period):
+        balance = self._balance(period)
+        pmi = self._PMI(balance)
+        if period == 0:
+            interest = np.zeros(len(self._face))
+            # The mortgage mixin subtracts PMI from principal due even in period 0.
+            principal = -pmi
+        else:
+            # Loans pay only within their term and before they default.
+            due = (period <= self._term) & (self._defaultPeriod > period)
+            interest = np.where(due, self._monthlyRate * self._scheduledBalance(period - 1), 0.0)
+            # Principal due is monthly payment (including PMI) minus interest due minus PMI.
+            principal = np.where(due, self._payment + pmi - interest, 0.0) - pmi
+        # Recovery value is calculated only for the defaulting period.
+        recovery = np.where(self._defaultPeriod == period, 0.6 * self._assetValue *
+                            (1 - self._monthlyDeprRate) ** period, 0.0)
+        return principal, interest, recovery, balance
+
+    # This returns the total loan principal of all loans in the list.
+    def totalPrincipal(self):
+        return self._face.sum()
+
+    # This returns the total loan balance of all loans for a given period.
+    def totalBalance(self, period):
+        return self._balance(period).sum()
+
+    # This returns the total monthly payment of all loans for a given period.
+    def totalMonthlyPmt(self, period=1):
+        due = (period != 0) & (period <= self._term) & (self._defaultPeriod > period)
+        return (np.where(due, self._payment, 0.0) + self._PMI(self._balance(period))).sum()
+
+    # This returns the total principal due of all loans for a given period.
+    def totalPrincipalDue(self, period):
+        return self._periodFlows(period)[0].sum()
+
+    # This returns the total interest due of all loans for a given period.
+    def totalInterestDue(self, period):
+        return self._periodFlows(period)[1].sum()
+
+    # This returns the total recovery values of all loans for a given period.
+    def totalRecoveries(self, period):
+        return self._periodFlows(period)[2].sum()
+
+    # This returns the total amount actually paid by all loans for a given period.
+    def totalMonthlyPaid(self, period):
+        principal, interest, recovery, balance = self._periodFlows(period)
+        return principal.sum() + interest.sum() + recovery.sum()
+
+    # This returns the indices of all active loans.
+    def activeLoans(self, period):
+        # Active loans are the ones with balance greater than 0 for a given period.
+        return np.flatnonzero(self._balance(period) > 0)
+
+    # This returns the weighted average rate of active loans.
+    def getWAR(self, period=0):
+        balance = self._balance(period)
+        return np.dot(balance, self._rate) / balance.sum()
+
+    # This returns the weighted average maturity of active loans.
+    def getWAM(self, period=0):
+        balance = self._balance(period)
+        return np.dot(balance, self._term - period) / balance.sum()
+
+    # This returns the scheduled principal, interest, and balance of the given loans over every
+    # period up to the pool's last maturity, ignoring default. Each is an array with one row per
+    # loan and one column per period. Period 0 is left empty for principal and interest.
+    def _scheduledFlows(self, loans):
+        periods = np.arange(int(self._maturity.max()) + 1)
+        monthly_rate = self._monthlyRate[loans, np.newaxis]
+        payment = self._payment[loans, np.newaxis]
+        term = self._term[loans, np.newaxis]
+        growth = (1 + monthly_rate) ** periods
+        balance = self._face[loans, np.newaxis] * growth - payment * (growth - 1) / monthly_rate
+        balance = np.where(periods < term, balance, 0.0)
+        # Loans pay from period 1 until the end of their term.
+        due = (periods >= 1) & (periods <= term)
+        interest = np.zeros(balance.shape)
+        interest[:, 1:] = monthly_rate * balance[:, :-1]
+        interest = np.where(due, interest, 0.0)
+        principal = np.where(due, payment - interest, 0.0)
+        return principal, interest, balance
+
+    # This builds the asset-side waterfall of every period when no loan defaults. Along with the
+    # cash flows, it counts the loans that pay in each period and the loans that still have a
+    # balance, so that periods left without any loan can be set to exactly 0 later on.
+    def _buildBaseline(self):
+        num_periods = int(self._maturity.max()) + 1
+        principal = np.zeros(num_periods)
+        interest = np.zeros(num_periods)
+        balance = np.zeros(num_periods)
+        # Loans never default in period 0, so its waterfall is the same in every simulation.
+        flows_0 = self._periodFlows(0)
+        principal[0], interest[0], balance[0] = flows_0[0].sum(), flows_0[1].sum(), flows_0[3].sum()
+        for period in range(1, num_periods):
+            growth = (1 + self._monthlyRate) ** (period - 1)
+            last_balance = np.where(period - 1 < self._term, self._face * growth -
+                                    self._payment * (growth - 1) / self._monthlyRate, 0.0)
+            due = period <= self._term
+            interest[period] = np.where(due, self._monthlyRate * last_balance, 0.0).sum()
+            principal[period] = np.where(due, self._payment, 0.0).sum() - interest[period]
+            balance[period] = self._scheduledBalance(period).sum()
+        # A loan pays from period 1 up to its maturity and has a balance before its maturity.
+        maturity_counts = np.bincount(self._maturity.clip(min=0).astype(int),
+                                      minlength=num_periods)
+        num_paying = len(self._face) - np.concatenate(([0], np.cumsum(maturity_counts)[:-1]))
+        num_balance = len(self._face) - np.cumsum(maturity_counts)
+        self._baseline = {'principal': principal, 'interest': interest, 'balance': balance,
+                          'num_paying': num_paying, 'num_balance': num_balance}
+
+    # This returns the asset-side waterfall of every period of the current simulation as an
+    # array with one row per period. Each row holds principal due, interest due, recovery value,
+    # total amount paid, and remaining balance, as in getWaterfall(). It starts from the waterfall
+    # without defaults and takes out the remaining cash flows of the defaulted loans, so its cost
+    # depends on the number of defaults rather than the number of loans. All of the simulation's
+    # defaults must be known, e.g. by calling checkDefaults(0) with 'time' default sampling.
+    def getWaterfallPath(self):
+        if self._baseline is None:
+            self._buildBaseline()
+        num_periods = len(self._baseline['principal'])
+        periods = np.arange(num_periods)
+        defaulted = np.flatnonzero(np.isfinite(self._defaultPeriod))
+        default_period = self._defaultPeriod[defaulted, np.newaxis]
+        maturity = self._maturity[defaulted, np.newaxis]
+        # The defaulted loans pay nothing and have no balance from their default period onwards.
+        lost = periods >= default_period
+        lost_principal, lost_interest, lost_balance = self._scheduledFlows(defaulted)
+        principal = self._baseline['principal'] - (lost_principal * lost).sum(axis=0)
+        interest = self._baseline['interest'] - (lost_interest * lost).sum(axis=0)
+        balance = self._baseline['balance'] - (lost_balance * lost).sum(axis=0)
+        num_paying = self._baseline['num_paying'] - (lost & (periods <= maturity)).sum(axis=0)
+        num_balance = self._baseline['num_balance'] - (lost & (periods < maturity)).sum(axis=0)
+        # Recovery value is calculated only for the defaulting period.
+        recovery = np.bincount(default_period[:, 0].astype(int), weights=(
+            0.6 * self._assetValue[defaulted] *
+            (1 - self._monthlyDeprRate[defaulted]) ** default_period[:, 0]),
+            minlength=num_periods)
+        # This removes the rounding errors left in periods without any loan. Period 0 is skipped
+        # since nothing is paid in it anyway.
+        principal[1:][num_paying[1:] == 0] = 0
+        interest[1:][num_paying[1:] == 0] = 0
+        balance[num_balance == 0] = 0
+        paid = principal + interest + recovery
+        # The waterfall ends in the first period after period 0 in which nothing is paid.
+        no_pay = np.flatnonzero(paid[1:] <= 0)
+        num_periods = no_pay[0] + 2 if len(no_pay) > 0 else len(paid)
+        return np.column_stack((principal, interest, recovery, paid, balance))[:num_periods]
+
+    # This returns the expected loss of the pool, i.e. the expected amount that is scheduled to be
+    # paid but is not, because the loans default. A loan defaulting in a period loses all of its
+    # remaining scheduled payments from that period on and recovers part of its asset's value.
+    # It is known exactly from the probabilities of default, so it can be used as a control variate.
+    def expectedLoss(self):
+        if self._expectedLoss is None:
+            self._expectedLoss = self._calculateExpectedLoss()
+        return self._expectedLoss
+
+    # This calculates the expected loss of the pool. The periods are gone through from the last
+    # one backwards, so that only one value per loan is kept at a time, as in _buildBaseline().
+    def _calculateExpectedLoss(self):
+        last_period = int(self._maturity.max())
+        default_prob = Loan.defaultPeriodProbabilities(last_period)
+        # remaining[i] is the total scheduled payment of loan i from the current period onwards.
+        remaining = np.zeros(len(self._face))
+        expected_loss = 0.0
+        for period in range(last_period, 0, -1):
+            remaining += np.where(period <= self._term, self._payment, 0.0)
+            recovery = 0.6 * self._assetValue * (1 - self._monthlyDeprRate) ** period
+            # Loans can default from period 1 up to their maturity.
+            can_default = period <= self._maturity
+            expected_loss += default_prob[period] * \
+                np.where(can_default, remaining - recovery, 0.0).sum()
+        return expected_loss
+
+    # This returns the information to be stored on the asset-side output file.
+    def getWaterfall(self, period):
+        principal, interest, recovery, balance = self._periodFlows(period)
+        total_principal = principal.sum()
+        total_interest = interest.sum()
+        total_recovery = recovery.sum()
+        return [total_principal, total_interest, total_recovery,
+                total_principal + total_interest + total_recovery, balance.sum()]
+
+    # This returns the number of loans that default in the current simulation.
+    def _numDefaults(self):
+        return np.count_nonzero(np.isfinite(self._defaultPeriod))
+
+    # This checks which loans should go into default. The random numbers are drawn from rng,
+    # which is a numpy Generator. If rng is None, numpy's global random state is used.
+    def checkDefaults(self, period, rng=None):
+        if rng is None:
+            rng = np.random
+        # In period 0, the default periods are reset.
+        if period == 0:
+            self._defaultPeriod[:] = np.inf
+            if self._defaultSampling == 'time':
+                # This draws one random number per loan and converts it into the loan's default
+                # period. Loans that would default only after their maturity do not default.
+                rand_nums = rng.uniform(size=len(self._face))
+                default_periods = Loan.sampleDefaultPeriods(
+                    rand_nums, int(self._maturity.max()), self._maturityDefaultProb,
+                    self._twistedDefaultProb)
+                self._defaultPeriod = np.where(default_periods <= self._maturity,
+                                               default_periods, np.inf)
+        # When default periods are sampled in period 0, there is nothing to check afterwards.
+        elif self._defaultSampling == 'time':
+            return
+        else:
+            # This finds the loans still active.
+            active = self.activeLoans(period - 1)
+            # Once every loan has matured or defaulted, there is nothing left to check.
+            if len(active) == 0:
+                return
+            # This generates one random number for each active loan.
+            rand_nums = rng.uniform(size=len(active))
+            # This marks every active loan whose random number is below the default probability.
+            if self._defaultTwist == 0:
+                default_prob = self._defaultProbCurve[period]
+            else:
+                default_prob = Loan.twistedPeriodDefaultProbabilities(
+                    period, self._cumDefaultProb, self._maturityDefaultProb[active],
+                    self._defaultTwist)
+            defaulted = active[rand_nums < default_prob]
+            self._defaultPeriod[defaulted] = period
+            if len(defaulted) > 0:
+                logging.debug('{0} loans entered default in period {1}.'
+                              .format(len(defaulted), period))
@@ -3,11 +3,17 @@ This module contains the Loan base class.
 '''
 # This imports Asset class, which is useful when checking if input is indeed an asset.
 from asset.asset_base import Asset
+import numpy as np
 import logging
+import math
 
 
 # This is the Loan base class, from which specific loan types will be derived.
 class Loan(object):
+    # This dict contains the probability of default for different periods. Each key is the first
+    # period at which the probability applies.
+    _defaultProbDict = {1: 0.0005, 11: 0.001, 61: 0.002, 121: 0.004, 181: 0.002, 211: 0.001}
+
     # This initializes an instance of Loan based on inputs given.
     def __init__(self, asset, face, rate, term):
         # This checks if the first input is an Asset. Exception is raised otherwise.
@@ -23,6 +29,11 @@ class Loan(object):
             self._term = term
             # This new data member keeps track of the period in which the loan defaults.
             self._defaultPeriod = None
+            # This holds the amortization schedule. It is built the first time it is needed.
+            self._schedule = None
+            # This holds the loan pools that contain the loan, each along with the loan's position
+            # in the pool. They are told about every change to the loan.
+            self._owners = []
 
     # This is the getter function for _asset.
     @property
@@ -32,6 +43,7 @@ class Loan(object):
     # This is the setter function for _asset.
     @asset.setter
     def asset(self, i_asset):
+        self._notifyChange()
         self._asset = i_asset
 
     # This is the getter function for _face.
@@ -42,13 +54,47 @@ class Loan(object):
     # This is the setter function for _face.
     @face.setter
     def face(self, i_face):
+        self._notifyChange()
         self._face = i_face
+        # The amortization schedule is no longer valid once the face value changes.
+        self._schedule = None
 
     # This will be overridden by derived classes.
     # This also makes Loan an abstract base class.
     def rate(self, period):
         raise NotImplementedError()
 
+    # This registers a loan pool that holds the loan at a given position. From then on, the pool is
+    # told about every change to the loan, so that it only has to update what it keeps about this
+    # loan.
+    def addOwner(self, pool, position):
+        self._owners.append((pool, position))
+
+    # This stops telling a loan pool about the changes to the loan.
+    def removeOwner(self, pool):
+        self._owners = [(owner, position) for owner, position in self._owners if owner is not pool]
+
+    # This tells the pools holding the loan that its asset, face value, rate, or term is about to
+    # change. They are told before the change, so that they can still take out what the loan
+    # contributes to their totals.
+    def _notifyChange(self):
+        for pool, position in self._owners:
+            pool.loanChanging(self, position)
+
+    # This is the getter function for _defaultPeriod.
+    @property
+    def defaultPeriod(self):
+        return self._defaultPeriod
+
+    # This is the setter function for _defaultPeriod.
+    @defaultPeriod.setter
+    def defaultPeriod(self, i_defaultPeriod):
+        last_default_period = self._defaultPeriod
+        self._defaultPeriod = i_defaultPeriod
+        # This tells the pools holding the loan, along with the default period it replaces.
+        for pool, position in self._owners:
+            pool.loanDefaultChanged(self, position, last_default_period)
+
     # This is the getter function for _term.
     @property
     def term(self):
@@ -57,7 +103,45 @@ class Loan(object):
     # This is the setter function for _term.
     @term.setter
     def term(self, i_term):
+        self._notifyChange()
         self._term = i_term
+        # The amortization schedule is no longer valid once the term changes.
+        self._schedule = None
+
+    # This is the setter function for _rate. The getter is the rate() function of derived classes.
+    def setRate(self, i_rate):
+        self._notifyChange()
+        self._rate = i_rate
+        # The amortization schedule is no longer valid once the rate changes.
+        self._schedule = None
+
+    # This builds the balance, interest, principal, and payment schedules over periods 0 to term
+    # as numpy arrays, so that the annuity formula is evaluated only once per loan.
+    def _buildSchedule(self):
+        # The schedule covers every period up to the first whole period at or after the term.
+        term = math.ceil(self._term)
+        monthly_rate = self.monthlyRate(self._rate)
+        payment = monthly_rate * self._face / (1 - (1 + monthly_rate) ** (-self._term))
+        # growth[i] is (1 + monthly_rate) ** i for every period i.
+        growth = (1 + monthly_rate) ** np.arange(term + 1)
+        balance = self._face * growth - payment * (growth - 1) / monthly_rate
+        # In period 0, balance is just face value. It is 0 from the end of the term onwards.
+        balance[0] = self._face
+        balance[term:] = 0
+        payments = np.full(term + 1, payment)
+        payments[0] = 0
+        # Interest due is period interest rate times last period's remaining balance.
+        interest = np.zeros(term + 1)
+        interest[1:] = monthly_rate * balance[:-1]
+        self._schedule = {'balance': balance, 'interest': interest,
+                          'principal': payments - interest, 'payment': payments}
+
+    # This returns the amortization schedule of the loan, ignoring any default.
+    @property
+    def schedule(self):
+        if self._schedule is None:
+            self._buildSchedule()
+        return self._schedule
 
     # This calculates the monthly payment.
     def monthlyPayment(self, period=1):
@@ -68,9 +152,8 @@ class Loan(object):
         elif self._defaultPeriod is not None and self._defaultPeriod <= period:
             return 0
         else:
-            # The actual calculation is done here.
-            monthly_rate = self.monthlyRate(self._rate)
-            return monthly_rate * self._face / (1 - (1 + monthly_rate) ** (-self._term))
+            # The payment is read from the precomputed schedule.
+            return self.schedule['payment'][period]
 
     # This calculates the sum of all payments across all periods.
     # The total payments is simply the number of months times the monthly payment.
@@ -94,12 +177,10 @@ class Loan(object):
         elif period == 0:
             return self._face
         else:
-            # The actual calculation is done here.
-            monthly_rate = self.monthlyRate(self._rate)
-            return self._face * (1 + monthly_rate) ** period - \
-                   self.monthlyPayment(period) * ((1 + monthly_rate) ** period - 1) / monthly_rate
+            # The balance is read from the precomputed schedule.
+            return self.schedule['balance'][period]
 
-    # This calculates the interest due. It calls for the formula-based balance function.
+    # This calculates the interest due. It reads from the precomputed amortization schedule.
     def interestDue(self, period):
         # This returns 0 for edge cases.
         if period == 0 or period > self._term:
@@ -108,10 +189,11 @@ class Loan(object):
         elif self._defaultPeriod is not None and self._defaultPeriod <= period:
             return 0
         else:
-            # Interest due is period interest rate times last period's remaining balance.
-            return self.monthlyRate(self._rate) * self.balance(period - 1)
+            # Interest due is period interest rate times last period's remaining balance. It is
+            # read from the precomputed schedule.
+            return self.schedule['interest'][period]
 
-    # This calculates the principal due. It calls for the formula-based interest due function.
+    # This calculates the principal due. It calls for the schedule-based interest due function.
     def principalDue(self, period):
         # This returns 0 for edge cases.
         if period == 0 or period > self._term:
@@ -194,17 +276,125 @@ class Loan(object):
     def totalPaid(self, period):
         return self.principalDue(period) + self.interestDue(period) + self.recoveryValue(period)
 
+    # This returns principal due, interest due, recovery value, total amount paid, and remaining
+    # balance for a given period, so the pool can gather all of them in a single pass.
+    def getWaterfall(self, period):
+        principal_due = self.principalDue(period)
+        interest_due = self.interestDue(period)
+        recovery_value = self.recoveryValue(period)
+        return (principal_due, interest_due, recovery_value,
+                principal_due + interest_due + recovery_value, self.balance(period))
+
+    # This returns the probability of default for a given period.
+    @classmethod
+    def defaultProbability(cls, period):
+        return cls._defaultProbDict[max(key for key in cls._defaultProbDict if key <= period)]
+
+    # This returns the probability of default for every period from 0 to last_period as a numpy
+    # array, so that a pool can look up the probability of a period without searching the dict.
+    @classmethod
+    def defaultProbabilityCurve(cls, last_period):
+        curve = np.zeros(last_period + 1)
+        # Loans never default in period 0.
+        for first_period in sorted(cls._defaultProbDict):
+            curve[first_period:] = cls._defaultProbDict[first_period]
+        return curve
+
+    # This returns the probability of defaulting in exactly each period from 0 to last_period as a
+    # numpy array, i.e. the probability of surviving every earlier period and then defaulting.
+    @classmethod
+    def defaultPeriodProbabilities(cls, last_period):
+        curve = cls.defaultProbabilityCurve(last_period)
+        survival = np.concatenate(([1.0], np.cumprod(1 - curve)[:-1]))
+        return survival * curve
+
+    # This returns the probability of defaulting in or before every period from 0 to last_period
+    # as a numpy array.
+    @classmethod
+    def cumulativeDefaultProbabilities(cls, last_period):
+        return 1 - np.cumprod(1 - cls.defaultProbabilityCurve(last_period))
+
+    # This converts uniform random numbers into default periods by inverting the cumulative
+    # probability of default up to last_period. It gives the same distribution as checking for
+    # default period by period, but needs only one random number per loan. A result greater than
+    # last_period means the loan does not default by then.
+    # If the number of defaults is tilted, default_prob and twisted_prob hold each loan's
+    # probability of defaulting by its maturity without and with the tilt. The random numbers are
+    # then mapped so that each loan defaults with its twisted_prob, and a loan that defaults does so
+    # in a period drawn from the same distribution as without the tilt.
+    @classmethod
+    def sampleDefaultPeriods(cls, rand_nums, last_period, default_prob=None, twisted_prob=None):
+        # cum_default[i] is the probability of defaulting in or before period i.
+        cum_default = cls.cumulativeDefaultProbabilities(last_period)
+        if twisted_prob is not None:
+            ones = np.ones(len(twisted_prob))
+            default_ratio = np.divide(default_prob, twisted_prob, out=ones.copy(),
+                                      where=twisted_prob > 0)
+            survival_ratio = np.divide(1 - default_prob, 1 - twisted_prob, out=ones,
+                                       where=twisted_prob < 1)
+            rand_nums = np.where(rand_nums < twisted_prob, rand_nums * default_ratio,
+                                 default_prob + (rand_nums - twisted_prob) * survival_ratio)
+        # Each loan defaults in the first period whose cumulative probability exceeds its number.
+        return np.searchsorted(cum_default, rand_nums, side='right')
+
+    # This returns each loan's probability of defaulting by its maturity once the number of
+    # defaults is tilted by twist, given the probabilities without the tilt. The tilt multiplies
+    # every loan's odds of defaulting by exp(twist), which weights each outcome by exp(twist) to the
+    # power of its number of defaults. The likelihood ratio of an outcome with K defaults is then
+    # exp(sum of log(1 + default_prob * (exp(twist) - 1)) - twist * K), which depends on the
+    # number of defaults only, however many loans there are.
+    @staticmethod
+    def twistDefaultProbabilities(default_prob, twist):
+        factor = math.exp(twist)
+        return default_prob * factor / (1 + default_prob * (factor - 1))
+
+    # This returns the twist of the number of defaults that raises its expected value by num_std
+    # standard deviations, given each loan's probability of defaulting by its maturity. Since the
+    # shift is measured in standard deviations of the number of defaults, the spread of the
+    # likelihood ratios does not grow with the number of loans. Error is raised if no twist can
+    # reach that expected value.
+    @classmethod
+    def defaultCountTwist(cls, default_prob, num_std):
+        if num_std == 0:
+            return 0.0
+        target = default_prob.sum() + num_std * math.sqrt((default_prob * (1 - default_prob)).sum())
+        if not 0 < target < np.count_nonzero(default_prob):
+            raise ValueError('Exception: This is not a valid default tilt.')
+        expected_defaults = lambda twist: cls.twistDefaultProbabilities(default_prob, twist).sum()
+        # The expected number of defaults grows with the twist, so the twist is found by bisection.
+        lower, upper = -1.0, 1.0
+        while expected_defaults(lower) > target:
+            lower *= 2
+        while expected_defaults(upper) < target:
+            upper *= 2
+        for i in range(100):
+            middle = (lower + upper) / 2
+            if expected_defaults(middle) < target:
+                lower = middle
+            else:
+                upper = middle
+        return (lower + upper) / 2
+
+    # This returns the probability that each loan still active in a period defaults in it, once
+    # the number of defaults is tilted by twist. cum_default is returned by
+    # cumulativeDefaultProbabilities(), and default_prob holds each loan's probability of
+    # defaulting by its maturity without the tilt. Drawing the defaults period by period with these
+    # probabilities gives the same distribution as sampleDefaultPeriods() with the same tilt.
+    @staticmethod
+    def twistedPeriodDefaultProbabilities(period, cum_default, default_prob, twist):
+        factor = math.exp(twist)
+        return factor * (cum_default[period] - cum_default[period - 1]) / \
+            (1 + default_prob * (factor - 1) - factor * cum_default[period - 1])
+
     # This checks if the loan should go into default.
     def checkDefault(self, period, rand_num):
         # In period 0, the default period is reset to 0.
         if period == 0:
-            self._defaultPeriod = None
+            self.defaultPeriod = None
         else:
-            # This dict contains the probability of default for different periods.
-            default_dict = {1: 0.0005, 11: 0.001, 61: 0.002, 121: 0.004, 181: 0.002, 211: 0.001}
             # This logic checks if the loan should go into default in this period.
-            if rand_num < default_dict[max(key for key in default_dict if key <= period)]:
-                self._defaultPeriod = period
+            if rand_num < self.defaultProbability(period):
+                self.defaultPeriod = period
                 return 1
             else:
                 return 0
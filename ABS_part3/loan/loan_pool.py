@@ -3,15 +3,54 @@ This module includes the LoanPool class, which composes of a list of loans.
 '''
 # This imports the 'reduce' method from functools.
 from functools import reduce
+from loan.loan_base import Loan
+from loan.pool_mixin import PoolMixin
 import numpy as np
 import logging
+import math
 
 
 # This is the LoanPool class, which contains a list of loans.
-class LoanPool(object):
+class LoanPool(PoolMixin):
     # The class requires a list of loans to initialize.
     def __init__(self, loan_list):
         self._loanList = loan_list
+        # This maps each loan's position in the list to the loan for every loan that is active in
+        # period _activePeriod. It is updated incrementally as the period advances.
+        self._activeIndex = None
+        self._activePeriod = 0
+        # This holds every loan with a positive term. The active index is reset to a copy of it.
+        # Everything that is built from the loans is built again from scratch while it is None.
+        self._activeTemplate = None
+        # These map a period to the positions of the loans that stop being active in that period,
+        # either because they mature or because they default.
+        self._maturityBuckets = {}
+        self._defaultBuckets = {}
+        # This holds the maturity of every loan, i.e. the last period in which it can default.
+        self._maturities = None
+        # This holds the probability of default for every period in which a loan can default.
+        self._defaultProbCurve = None
+        # These hold the probability of defaulting in or before every period, and each loan's
+        # probability of defaulting by its maturity.
+        self._cumDefaultProb = None
+        self._maturityDefaultProb = None
+        # Defaults are either checked period by period ('period') or sampled for the whole
+        # simulation in period 0 ('time').
+        self._defaultSampling = 'period'
+        # The number of defaults can be tilted, so that its expected value is raised by this many
+        # standard deviations. With a tilt other than 0, likelihoodRatio() gives the weight of each
+        # simulation. _defaultTwist is the corresponding twist (see Loan.defaultCountTwist()).
+        self._defaultTilt = 0.0
+        self._defaultTwist = 0.0
+        self._twistedDefaultProb = None
+        self._logTwistFactor = 0.0
+        # This holds the asset-side waterfall of every period when no loan defaults.
+        self._baseline = None
+        # This holds the expected loss of the pool once it has been calculated.
+        self._expectedLoss = None
+        # This holds the positions of the loans whose schedules have changed since the information
+        # above was last brought up to date.
+        self._changedLoans = set()
 
     # This returns the total loan principal of all loans in the list.
     def totalPrincipal(self):
@@ -50,8 +89,153 @@ class LoanPool(object):
 
     # This returns a list of all active loans.
     def activeLoans(self, period):
-        # Active loans are the ones with balance greater than 0 for a given period.
-        return [loan for loan in self._loanList if loan.balance(period) > 0]
+        # Active loans are the ones with balance greater than 0 for a given period, i.e. the ones
+        # that have neither matured nor defaulted. They are read from the active index.
+        return list(self._activeLoanIndex(period).values())
+
+    # This returns the active index for a given period. Moving forward only removes the loans
+    # that mature or default in the periods passed, so the cost depends on the number of changes
+    # rather than the number of loans.
+    def _activeLoanIndex(self, period):
+        self._syncWithLoans()
+        # Going back in time requires replaying the changes from period 0.
+        if self._activeIndex is None or period < self._activePeriod:
+            self._activeIndex = self._activeTemplate.copy()
+            self._activePeriod = 0
+        while self._activePeriod < period:
+            self._activePeriod += 1
+            for i in self._maturityBuckets.get(self._activePeriod, ()):
+                self._activeIndex.pop(i, None)
+            for i in self._defaultBuckets.get(self._activePeriod, ()):
+                self._activeIndex.pop(i, None)
+        return self._activeIndex
+
+    # This builds the active index template, the maturity buckets, and the probability of default
+    # curve from the loans' terms.
+    def _buildActiveTemplate(self):
+        self._activeTemplate = {}
+        self._maturityBuckets = {}
+        # A loan stops being active in the first whole period at or after its term.
+        maturities = [math.ceil(loan.term) for loan in self._loanList]
+        for i, (loan, maturity) in enumerate(zip(self._loanList, maturities)):
+            if maturity > 0:
+                self._activeTemplate[i] = loan
+            self._maturityBuckets.setdefault(maturity, []).append(i)
+        self._maturities = np.array(maturities)
+        # A loan can only default while it is active, i.e. up to its maturity.
+        self._defaultProbCurve = Loan.defaultProbabilityCurve(self._maturities.max())
+        self._cumDefaultProb = Loan.cumulativeDefaultProbabilities(self._maturities.max())
+        self._maturityDefaultProb = self._cumDefaultProb[self._maturities.clip(min=0)]
+
+    # This makes sure that the information kept about the loans is up to date. The loans tell the
+    # pool about their changes (see loanChanging() and loanDefaultChanged()), so only the loans
+    # that have changed are gone through again. Everything is built from all the loans the first
+    # time, and again once the list of loans itself changes.
+    def _syncWithLoans(self):
+        if self._activeTemplate is None or len(self._loanList) != len(self._maturities):
+            self._buildFromLoans()
+        elif self._changedLoans:
+            self._updateChangedLoans()
+
+    # This builds everything that is kept about the loans from scratch, and registers the pool with
+    # every loan at its position.
+    def _buildFromLoans(self):
+        self._buildActiveTemplate()
+        for i, loan in enumerate(self._loanList):
+            loan.removeOwner(self)
+            loan.addOwner(self, i)
+        self._changedLoans = set()
+        self._activeIndex = None
+        self._baseline = None
+        self._expectedLoss = None
+        # The tilt is kept in standard deviations of the number of defaults, which depends on the
+        # loans' maturities.
+        self._setDefaultTwist(Loan.defaultCountTwist(self._maturityDefaultProb, self._defaultTilt))
+        self._readDefaults()
+
+    # This brings the information kept about the loans whose schedules have changed up to date.
+    # Their old cash flows have already been taken out of the baseline and the expected loss (see
+    # loanChanging()), so their new ones are added back. If a loan now matures after every period
+    # covered so far, or starts or stops having a positive term, everything is built again instead.
+    def _updateChangedLoans(self):
+        changed_loans = sorted(self._changedLoans)
+        self._changedLoans = set()
+        for i in changed_loans:
+            last_maturity = self._maturities[i]
+            maturity = math.ceil(self._loanList[i].term)
+            if maturity >= len(self._cumDefaultProb) or (maturity > 0) != (last_maturity > 0):
+                self._buildFromLoans()
+                return
+            if maturity != last_maturity:
+                self._maturityBuckets[last_maturity].remove(i)
+                self._maturityBuckets.setdefault(maturity, []).append(i)
+                self._maturities[i] = maturity
+                self._maturityDefaultProb[i] = self._cumDefaultProb[max(maturity, 0)]
+            if self._baseline is not None:
+                self._addToBaseline(i)
+            if self._expectedLoss is not None:
+                self._expectedLoss += self._loanExpectedLoss(i)
+        # The active index is replayed from period 0 with the new maturities.
+        self._activeIndex = None
+        self._setDefaultTwist(Loan.defaultCountTwist(self._maturityDefaultProb, self._defaultTilt))
+
+    # This returns True if the loan is at the given position, so that the pool can take in the
+    # loan's change. If the list of loans has been changed, everything is to be built again and
+    # False is returned. False is also returned if nothing has been built yet.
+    def _holdsLoan(self, loan, position):
+        if self._activeTemplate is None:
+            return False
+        if position < len(self._loanList) and self._loanList[position] is loan:
+            return True
+        self._activeTemplate = None
+        return False
+
+    # This is called by a loan of the pool right before its asset, face value, rate, or term
+    # changes. The loan's cash flows are taken out of the baseline and the expected loss while they
+    # are still the old ones, and the rest is brought up to date the next time it is needed.
+    def loanChanging(self, loan, position):
+        if not self._holdsLoan(loan, position) or position in self._changedLoans:
+            return
+        self._changedLoans.add(position)
+        if self._baseline is not None:
+            self._addToBaseline(position, -1)
+        if self._expectedLoss is not None:
+            self._expectedLoss -= self._loanExpectedLoss(position)
+
+    # This is called by a loan of the pool once its default period has changed. The loan is moved
+    # from the default bucket of its last default period to the bucket of its new one.
+    def loanDefaultChanged(self, loan, position, last_default_period):
+        if not self._holdsLoan(loan, position):
+            return
+        if last_default_period is not None:
+            defaulted = self._defaultBuckets.get(last_default_period, [])
+            if position in defaulted:
+                defaulted.remove(position)
+                if not defaulted:
+                    del self._defaultBuckets[last_default_period]
+            # If the active index has moved past the last default, the loan has to be put back.
+            # That takes replaying the active index from period 0.
+            if self._activeIndex is not None and self._activePeriod >= last_default_period:
+                self._activeIndex = None
+        if loan.defaultPeriod is not None:
+            self._defaultBuckets.setdefault(loan.defaultPeriod, []).append(position)
+            # If the active index has already moved past the default, the loan is removed right
+            # away.
+            if self._activeIndex is not None and self._activePeriod >= loan.defaultPeriod:
+                self._activeIndex.pop(position, None)
+
+    # This rebuilds the default buckets from the default periods recorded on the loans.
+    def _readDefaults(self):
+        self._defaultBuckets = {}
+        for i, loan in enumerate(self._loanList):
+            if loan.defaultPeriod is not None:
+                self._defaultBuckets.setdefault(loan.defaultPeriod, []).append(i)
+        self._activeIndex = None
+
+    # This sends the loan at a given position into default in a given period. The loan then tells
+    # the pool, which records the default (see loanDefaultChanged()).
+    def _recordDefault(self, i, period):
+        self._loanList[i].defaultPeriod = period
 
     # This returns the weighted average rate of active loans.
     # Loans that are completely paid down should no longer matter.
@@ -79,27 +263,199 @@ class LoanPool(object):
         for loan in self._loanList:
             yield loan
 
+    # This returns the number of loans in the pool.
+    def __len__(self):
+        return len(self._loanList)
+
     # This returns the information to be stored on the asset-side output file.
+    # Principal due, interest due, recovery value, total amount paid, and remaining balance are
+    # all gathered from a single pass over the loans.
     def getWaterfall(self, period):
-        return [self.totalPrincipalDue(period), self.totalInterestDue(period),
-                self.totalRecoveries(period), self.totalMonthlyPaid(period),
-                self.totalBalance(period)]
+        principal = interest = recovery = paid = balance = 0
+        for loan in self._loanList:
+            loan_principal, loan_interest, loan_recovery, loan_paid, loan_balance = \
+                loan.getWaterfall(period)
+            principal += loan_principal
+            interest += loan_interest
+            recovery += loan_recovery
+            paid += loan_paid
+            balance += loan_balance
+        return [principal, interest, recovery, paid, balance]
+
+    # This builds the asset-side waterfall of every period when no loan defaults. Along with the
+    # cash flows, it counts the loans that pay in each period and the loans that still have a
+    # balance, so that periods left without any loan can be set to exactly 0 later on. It covers
+    # the same periods as the probability of default curve.
+    def _buildBaseline(self):
+        self._syncWithLoans()
+        num_periods = len(self._cumDefaultProb)
+        principal = np.zeros(num_periods)
+        interest = np.zeros(num_periods)
+        balance = np.zeros(num_periods)
+        for loan in self._loanList:
+            schedule = loan.schedule
+            principal[:len(schedule['principal'])] += schedule['principal']
+            interest[:len(schedule['interest'])] += schedule['interest']
+            balance[:len(schedule['balance'])] += schedule['balance']
+        # Loans never default in period 0, so its waterfall is the same in every simulation.
+        waterfall_0 = self.getWaterfall(0)
+        principal[0], interest[0], balance[0] = waterfall_0[0], waterfall_0[1], waterfall_0[4]
+        # A loan pays from period 1 up to its maturity and has a balance before its maturity.
+        maturity_counts = np.bincount(self._maturities.clip(min=0), minlength=num_periods)
+        num_paying = len(self._loanList) - np.concatenate(([0], np.cumsum(maturity_counts)[:-1]))
+        num_balance = len(self._loanList) - np.cumsum(maturity_counts)
+        self._baseline = {'principal': principal, 'interest': interest, 'balance': balance,
+                          'num_paying': num_paying, 'num_balance': num_balance}
+
+    # This adds the cash flows of the loan at position i without default to the baseline, or takes
+    # them out if sign is -1. Period 0 is taken from the loan's waterfall, as in _buildBaseline().
+    def _addToBaseline(self, i, sign=1):
+        loan = self._loanList[i]
+        schedule = loan.schedule
+        waterfall_0 = loan.getWaterfall(0)
+        for name, column in (('principal', 0), ('interest', 1), ('balance', 4)):
+            self._baseline[name][1:len(schedule[name])] += sign * schedule[name][1:]
+            self._baseline[name][0] += sign * waterfall_0[column]
+        maturity = max(self._maturities[i], 0)
+        self._baseline['num_paying'][:maturity + 1] += sign
+        self._baseline['num_balance'][:maturity] += sign
+
+    # This returns the asset-side waterfall of every period of the current simulation as an
+    # array with one row per period. Each row holds principal due, interest due, recovery value,
+    # total amount paid, and remaining balance, as in getWaterfall(). It starts from the waterfall
+    # without defaults and takes out the remaining cash flows of the defaulted loans, so its cost
+    # depends on the number of defaults rather than the number of loans. All of the simulation's
+    # defaults must be known, e.g. by calling checkDefaults(0) with 'time' default sampling.
+    def getWaterfallPath(self):
+        self._syncWithLoans()
+        if self._baseline is None:
+            self._buildBaseline()
+        principal = self._baseline['principal'].copy()
+        interest = self._baseline['interest'].copy()
+        balance = self._baseline['balance'].copy()
+        num_paying = self._baseline['num_paying'].copy()
+        num_balance = self._baseline['num_balance'].copy()
+        recovery = np.zeros(len(principal))
+        for period, defaulted in self._defaultBuckets.items():
+            for i in defaulted:
+                loan = self._loanList[i]
+                schedule = loan.schedule
+                maturity = self._maturities[i]
+                # The loan pays nothing and has no balance from its default period onwards.
+                principal[period:maturity + 1] -= schedule['principal'][period:]
+                interest[period:maturity + 1] -= schedule['interest'][period:]
+                balance[period:maturity + 1] -= schedule['balance'][period:]
+                num_paying[period:maturity + 1] -= 1
+                num_balance[period:maturity] -= 1
+                recovery[period] += loan.recoveryValue(period)
+        # This removes the rounding errors left in periods without any loan. Period 0 is skipped
+        # since nothing is paid in it anyway.
+        principal[1:][num_paying[1:] == 0] = 0
+        interest[1:][num_paying[1:] == 0] = 0
+        balance[num_balance == 0] = 0
+        paid = principal + interest + recovery
+        # The waterfall ends in the first period after period 0 in which nothing is paid.
+        no_pay = np.flatnonzero(paid[1:] <= 0)
+        num_periods = no_pay[0] + 2 if len(no_pay) > 0 else len(paid)
+        return np.column_stack((principal, interest, recovery, paid, balance))[:num_periods]
+
+    # This returns the expected loss of the pool, i.e. the expected amount that is scheduled to be
+    # paid but is not, because the loans default. A loan defaulting in a period loses all of its
+    # remaining scheduled payments from that period on and recovers part of its asset's value.
+    # It is known exactly from the probabilities of default, so it can be used as a control variate.
+    def expectedLoss(self):
+        self._syncWithLoans()
+        if self._expectedLoss is None:
+            self._expectedLoss = self._calculateExpectedLoss()
+        return self._expectedLoss
+
+    # This calculates the expected loss of the pool.
+    def _calculateExpectedLoss(self):
+        self._syncWithLoans()
+        default_prob = Loan.defaultPeriodProbabilities(self._maturities.max())
+        expected_loss = 0.0
+        for i in range(len(self._loanList)):
+            expected_loss += self._loanExpectedLoss(i, default_prob)
+        return expected_loss
+
+    # This returns the expected loss of the loan at position i. default_prob holds the probability
+    # of defaulting in exactly each period, at least up to the loan's maturity.
+    def _loanExpectedLoss(self, i, default_prob=None):
+        maturity = self._maturities[i]
+        if maturity < 1:
+            return 0.0
+        if default_prob is None:
+            default_prob = Loan.defaultPeriodProbabilities(maturity)
+        loan = self._loanList[i]
+        schedule = loan.schedule
+        periods = np.arange(1, maturity + 1)
+        # remaining[p - 1] is the total scheduled payment of the loan from period p onwards.
+        payments = (schedule['principal'] + schedule['interest'])[1:maturity + 1]
+        remaining = np.cumsum(payments[::-1])[::-1]
+        recovery = 0.6 * loan.asset.currentVal(periods)
+        return np.dot(remaining - recovery, default_prob[1:maturity + 1])
+
+    # This draws one random number per loan and converts it into the loan's default period. Loans
+    # that would default only after their maturity do not default at all.
+    def _sampleDefaultTimes(self, rng):
+        self._syncWithLoans()
+        rand_nums = rng.uniform(size=len(self._loanList))
+        default_periods = Loan.sampleDefaultPeriods(rand_nums, self._maturities.max(),
+                                                    self._maturityDefaultProb,
+                                                    self._twistedDefaultProb)
+        defaulted = np.flatnonzero(default_periods <= self._maturities)
+        for i in defaulted:
+            self._recordDefault(i, int(default_periods[i]))
+        logging.debug('{0} loans will enter default in this simulation.'.format(len(defaulted)))
+
+    # This returns the number of loans that default in the current simulation.
+    def _numDefaults(self):
+        return sum(len(defaulted) for defaulted in self._defaultBuckets.values())
 
-    # This tells each loan to check if it should go into default.
-    def checkDefaults(self, period):
+    # This tells each loan to check if it should go into default. The random numbers are drawn
+    # from rng, which is a numpy Generator. If rng is None, numpy's global random state is used.
+    def checkDefaults(self, period, rng=None):
+        if rng is None:
+            rng = np.random
+        self._syncWithLoans()
         # Loans should never default in period 0.
         if period == 0:
-            for loan in self._loanList:
-                loan.checkDefault(period, 0)
+            # Only the loans that defaulted in the last simulation need to be reset. Each of them
+            # takes itself out of the default buckets (see loanDefaultChanged()).
+            for i in [i for defaulted in self._defaultBuckets.values() for i in defaulted]:
+                self._loanList[i].defaultPeriod = None
+            # The active index starts over from all loans once the defaults are cleared.
+            self._activeIndex = None
+            if self._defaultSampling == 'time':
+                self._sampleDefaultTimes(rng)
+        # When default periods are sampled in period 0, there is nothing to check afterwards.
+        elif self._defaultSampling == 'time':
+            return
         else:
-            # This checks the number of loans still active.
-            num_active = len(self.activeLoans(period - 1))
-            # This generates one random number for each active loan.
-            rand_iter = iter(np.random.uniform(size=num_active))
-            # This keeps track of the number of loans that went into default each period.
-            default_counter = 0
-            for loan in self.activeLoans(period - 1):
-                default_counter += loan.checkDefault(period, next(rand_iter))
-            if default_counter > 0:
-                logging.debug('{0} loans entered default in period {1}.'
-                              .format(default_counter, period))
+            # This gets the loans still active, keyed by their positions in the list.
+            active_index = self._activeLoanIndex(period - 1)
+            # Once every loan has matured or defaulted, there is nothing left to check.
+            if not active_index:
+                return
+            # This generates one random number for each active loan, in the order of the active
+            # index. Every random number below the period's probability of default sends its loan
+            # into default. The positions of the active loans are only read from the index when
+            # they are needed.
+            rand_nums = rng.uniform(size=len(active_index))
+            active = None
+            if self._defaultTwist == 0:
+                default_prob = self._defaultProbCurve[period]
+            else:
+                active = np.fromiter(active_index, dtype=int, count=len(active_index))
+                default_prob = Loan.twistedPeriodDefaultProbabilities(
+                    period, self._cumDefaultProb, self._maturityDefaultProb[active],
+                    self._defaultTwist)
+            is_default = rand_nums < default_prob
+            if not is_default.any():
+                return
+            if active is None:
+                active = np.fromiter(active_index, dtype=int, count=len(active_index))
+            defaulted = active[is_default].tolist()
+            for i in defaulted:
+                self._recordDefault(i, period)
+            logging.debug('{0} loans entered default in period {1}.'.format(len(defaulted), period))
@@ -0,0 +1,71 @@
+'''
+This module contains the PoolMixin class, which holds what LoanPool and ArrayLoanPool share about
+the loss and the sampling of defaults of a pool.
+'''
+from loan.loan_base import Loan
+import numpy as np
+import math
+
+
+# The PoolMixin class contains the functionalities shared by LoanPool and ArrayLoanPool. A pool that
+# uses it provides _buildBaseline() and _numDefaults(), and the attributes _baseline, _defaultTilt,
+# _defaultSampling, and _maturityDefaultProb.
+class PoolMixin(object):
+    # This brings the pool in line with any change made to its loans. A pool that is built from
+    # loan objects overrides it; a pool that holds its own data never needs to.
+    def _syncWithLoans(self):
+        pass
+
+    # This returns the loss of the pool in a simulation, given the simulation's asset-side
+    # waterfall, one row per period as returned by getWaterfall().
+    def pathLoss(self, asset_path):
+        self._syncWithLoans()
+        if self._baseline is None:
+            self._buildBaseline()
+        scheduled = self._baseline['principal'][1:].sum() + self._baseline['interest'][1:].sum()
+        return scheduled - np.asarray(asset_path)[1:, 3].sum()
+
+    # This is the getter function for _defaultTilt.
+    @property
+    def defaultTilt(self):
+        return self._defaultTilt
+
+    # This is the setter function for _defaultTilt, the number of standard deviations by which the
+    # expected number of defaults is raised (see Loan.defaultCountTwist()).
+    @defaultTilt.setter
+    def defaultTilt(self, i_defaultTilt):
+        self._syncWithLoans()
+        # Error is raised if no tilt of the number of defaults gives the requested expected value.
+        self._setDefaultTwist(Loan.defaultCountTwist(self._maturityDefaultProb, i_defaultTilt))
+        self._defaultTilt = i_defaultTilt
+
+    # This sets the twist of the number of defaults, along with each loan's tilted probability of
+    # defaulting by its maturity and the log of the factor shared by all likelihood ratios.
+    def _setDefaultTwist(self, twist):
+        self._defaultTwist = twist
+        self._twistedDefaultProb = None if twist == 0 else \
+            Loan.twistDefaultProbabilities(self._maturityDefaultProb, twist)
+        self._logTwistFactor = np.log1p(self._maturityDefaultProb * math.expm1(twist)).sum()
+
+    # This is the getter function for _defaultSampling.
+    @property
+    def defaultSampling(self):
+        return self._defaultSampling
+
+    # This is the setter function for _defaultSampling.
+    @defaultSampling.setter
+    def defaultSampling(self, i_defaultSampling):
+        # Error is raised if input is not one of the two allowed values.
+        if i_defaultSampling in ('period', 'time'):
+            self._defaultSampling = i_defaultSampling
+        else:
+            raise ValueError('Exception: This is not a valid mode of default sampling.')
+
+    # This returns the likelihood ratio of the current simulation's defaults, i.e. their probability
+    # without the tilt over their probability with it. It is the weight that makes the results of
+    # a tilted simulation unbiased. It only depends on the number of defaults.
+    def likelihoodRatio(self):
+        self._syncWithLoans()
+        if self._defaultTwist == 0:
+            return 1.0
+        return math.exp(self._logTwistFactor - self._defaultTwist * self._numDefaults())
@@ -0,0 +1,87 @@
+'''
+This module checks that a LoanPool keeps up with changes made directly to its loans, by comparing
+it with a new pool of the same loans. It is run with python -m pytest from the ABS_part3 folder.
+'''
+from loan.auto_loan import AutoLoan
+from loan.loan_pool import LoanPool
+from asset.cars import Car
+import numpy as np
+
+
+# This returns num_loans auto loans of random face values, rates, and terms.
+def makeLoans(rng, num_loans):
+    return [AutoLoan(Car(rng.uniform(10 ** 4, 5 * 10 ** 4)), rng.uniform(5000, 40000),
+                     rng.uniform(0.02, 0.1), float(rng.integers(12, 72)))
+            for i in range(num_loans)]
+
+
+# This checks that the pool gives the same results as a new pool of the same loans. The new pool
+# is then taken off the loans.
+def checkSameAsNewPool(pool, loans):
+    new_pool = LoanPool(loans)
+    new_pool.defaultTilt = pool.defaultTilt
+    assert np.allclose(pool.getWaterfallPath(), new_pool.getWaterfallPath(), rtol=10 ** -12,
+                       atol=10 ** -6)
+    assert np.isclose(pool.expectedLoss(), new_pool.expectedLoss(), rtol=10 ** -12)
+    assert np.isclose(pool.likelihoodRatio(), new_pool.likelihoodRatio(), rtol=10 ** -12)
+    for period in (0, 5, 30, 80):
+        assert [id(loan) for loan in pool.activeLoans(period)] == \
+            [id(loan) for loan in new_pool.activeLoans(period)]
+    for loan in loans:
+        loan.removeOwner(new_pool)
+
+
+# This checks that the pool takes in changes to the schedules of some of its loans, including ones
+# that move their maturity past the pool's last period or down to a fraction of a period, once
+# its baseline and expected loss have been calculated.
+def testScheduleChanges():
+    rng = np.random.default_rng(4)
+    loans = makeLoans(rng, 50)
+    pool = LoanPool(loans)
+    pool.defaultSampling = 'time'
+    pool.defaultTilt = 1.0
+    pool.checkDefaults(0, rng)
+    pool.getWaterfallPath()
+    pool.expectedLoss()
+    loans[3].face *= 2
+    loans[7].setRate(0.15)
+    loans[7].setRate(0.12)
+    loans[11].term = loans[11].term - 5
+    checkSameAsNewPool(pool, loans)
+    loans[12].term = 100
+    checkSameAsNewPool(pool, loans)
+    loans[13].term = 1.5
+    checkSameAsNewPool(pool, loans)
+
+
+# This checks that the pool takes in default periods set directly on its loans, and that only the
+# loans that have defaulted are reset in period 0.
+def testDefaultChanges():
+    rng = np.random.default_rng(4)
+    loans = makeLoans(rng, 50)
+    pool = LoanPool(loans)
+    pool.checkDefaults(0, rng)
+    for period in range(1, 40):
+        pool.checkDefaults(period, rng)
+    loans[0].defaultPeriod = 5
+    loans[1].defaultPeriod = 20
+    checkSameAsNewPool(pool, loans)
+    loans[0].defaultPeriod = None
+    checkSameAsNewPool(pool, loans)
+    pool.checkDefaults(0, rng)
+    assert all(loan.defaultPeriod is None for loan in loans)
+    checkSameAsNewPool(pool, loans)
+
+
+# This checks that the pool is built again once the list of loans itself changes.
+def testLoanListChanges():
+    rng = np.random.default_rng(4)
+    loans = makeLoans(rng, 50)
+    pool = LoanPool(loans)
+    pool.getWaterfallPath()
+    loans.append(makeLoans(rng, 1)[0])
+    checkSameAsNewPool(pool, loans)
+    removed_loan = loans.pop(0)
+    checkSameAsNewPool(pool, loans)
+    removed_loan.face *= 2
+    checkSameAsNewPool(pool, loans)
@@ -11,23 +11,31 @@ to carry out the inner loops one by one.
 from loan.auto_loan import AutoLoan
 from loan.mortgage_mixin import FixedMortgage, VariableMortgage
 from loan.loan_pool import LoanPool
+from loan.array_loan_pool import ArrayLoanPool
 from asset.cars import Car
 from asset.houses import PrimaryHome, VacationHome
 from liability.tranche import StandardTranche
 from liability.securities import StructuredSecurities
+from liability.irr import batchIRR
 import os
-import numpy_financial as npf
-import functools
+import numpy as np
 import logging
 from timer.timer import Timer
+from worker.worker_pool import WorkerPool
+from stats.running_stats import SimulationStats, ReplicatedStats
+from stats.sampling import AntitheticGenerator, QuasiRandomSampler
+from solver.rate_solver import RelaxationSolver
+from waterfall.engine import runWaterfall
+from waterfall.sinks import CSVSink
 import math
 import multiprocessing
-import copy
+import collections
+import time
 
 
 # This function loads the 1500 loans from Loans.csv and returns a LoanPool object containing the
-# loans.
-def loadAssets():
+# loans. If columnar is True, the loans are stored in an ArrayLoanPool instead.
+def loadAssets(columnar=False):
     # This dict provides the conversion between the "Loan Type" as entered in the Loans.csv and
     # the loan constructor function to be called. Though there are only auto loans in the csv,
     # this allows the program to be more generic.
@@ -64,226 +72,674 @@ def loadAssets():
             # This adds one loan to the list.
             loan_list.append(single_loan)
     # This returns the LoanPool object containing all the loans.
+    if columnar:
+        return ArrayLoanPool.fromLoans(loan_list)
     return LoanPool(loan_list)
 
 
-# This executes the ABS waterfall once and calculates the waterfall metrics.
-def doMiniWaterfall(loaded_pool, structured_deal):
+# This returns the random number generator of the i-th simulation. Each simulation gets its own
+# independent stream derived from the seed, so results do not depend on how simulations are split
+# between processes or in which order they are carried out. If antithetic is True, simulations
+# 2k and 2k + 1 share a stream, and the latter draws the antithetic random numbers of the former.
+# If a QuasiRandomSampler is given, the random numbers come from its low-discrepancy points instead.
+def getGenerator(seed, i, antithetic=False, sampler=None):
+    if sampler is not None:
+        return sampler.getGenerator(seed, i)
+    if not antithetic:
+        return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(i,)))
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(i // 2,)))
+    return AntitheticGenerator(rng) if i % 2 else rng
+
+
+# This simulates the asset side once and returns the asset-side waterfall of every period. Each
+# row holds principal due, interest due, recovery value, total amount paid, and remaining balance.
+# Defaults are drawn from rng, a numpy Generator.
+def simulateAssets(loaded_pool, rng=None):
+    # When default periods are sampled in period 0, all defaults of the simulation are known right
+    # away. The pool then takes the defaulted loans out of its precomputed waterfall without
+    # defaults instead of going through every loan in every period.
+    if loaded_pool.defaultSampling == 'time':
+        loaded_pool.checkDefaults(0, rng)
+        return loaded_pool.getWaterfallPath()
+    # This list holds the asset-side waterfall of each period.
+    asset_path = []
     # The period is initialized to 0.
     period = 0
-    # This loop executes the waterfall.
-    # The loop continues as long as there is still cash flow from the assets.
-    while period == 0 or loaded_pool.totalMonthlyPaid(period) > 0:
+    while True:
         # First, we check if any loan within the pool should go into default.
-        loaded_pool.checkDefaults(period)
+        loaded_pool.checkDefaults(period, rng)
         # On the asset side, getWaterfall() returns principal due, interest due, recovery
         # value, total monthly payment, and remaining balance.
         asset_waterfall = loaded_pool.getWaterfall(period)
-        if period != 0:
-            # This increases the period on the liability side by 1.
-            structured_deal.increaseTimePeriodForAll()
-            # Making payments to the liabilities requires information about the interest
-            # payments and principal payments from the assets.
-            structured_deal.makePayments(asset_waterfall[1], asset_waterfall[0])
+        # The loop continues as long as there is still cash flow from the assets. The total
+        # amount paid from getWaterfall() is reused here instead of being calculated again.
+        if period != 0 and asset_waterfall[3] <= 0:
+            break
+        asset_path.append(asset_waterfall)
         period += 1
+    return asset_path
+
+
+# This simulates the asset side of simulations start to NSIM - 1 and returns the list of asset
+# paths, each along with its likelihood ratio, which is 1 unless the pool's probabilities of default
+# are tilted. The asset side does not depend on the tranche rates, so the same paths can be replayed
+# in every outer loop.
+def generateAssetPaths(loaded_pool, NSIM, seed, antithetic=False, sampler=None, start=0):
+    asset_paths = []
+    for i in range(start, NSIM):
+        asset_path = simulateAssets(loaded_pool, getGenerator(seed, i, antithetic, sampler))
+        asset_paths.append((asset_path, loaded_pool.likelihoodRatio()))
+    return asset_paths
+
+
+# This executes the ABS waterfall once, reports every period to the sink, e.g. a CSVSink, and
+# prints the waterfall metrics of each tranche.
+def doWaterfall(loaded_pool, structured_deal, sink, rng=None):
+    res = payLiabilities(simulateAssets(loaded_pool, rng), structured_deal, sink)
+    for subordination, (tranche_DIRR, AL) in res.items():
+        print('\nClass {}'.format(subordination))
+        print('DIRR: {:.2f}bps'.format(tranche_DIRR * 10000))
+        print('Rating: {}'.format(getRating(tranche_DIRR)))
+        # If the tranche is never paid off, then its AL is displayed as None.
+        print('AL: {}'.format('None' if AL is None else '{:.2f} months'.format(AL)))
+    return res
+
+
+# This executes the liability side of the waterfall for a given asset path and calculates the
+# waterfall metrics. The periods are reported to the sink, if one is given.
+def payLiabilities(asset_path, structured_deal, sink=None):
+    # This executes the waterfall on the liability side.
+    runWaterfall(asset_path, structured_deal, sink)
     single_res = {}
-    for tranche in structured_deal:
-        # This calculates the IRR for each tranche.
-        tranche_IRR = npf.irr(tranche.cashFlow) * 12
-        # This calculates the DIRR for each tranche.
-        tranche_DIRR = tranche.rate - tranche_IRR
-        # This sets DIRR to 0 below a certain threshold, in order to avoid problems when using
-        # DIRR to calculate yield.
-        if tranche_DIRR < (tranche.rate * 10 ** (-6)):
-            tranche_DIRR = 0.0
-        # If the ending balance of the tranche is greater than 0, that means the tranche is not
-        # completely paid off. So AL should return None.
-        if tranche.notionalBalance() > 0:
-            AL = None
-        else:
-            # This calculates AL using reduce().
-            AL = functools.reduce(lambda total, pmt: total + pmt[0] * pmt[1],
-                                  enumerate(tranche.principalPaid), 0.0) / tranche.notional
+    # This calculates the annual IRR of all the tranches at once, starting from their coupons. The
+    # tranches all have a cash flow for every period, so their cash flows line up.
+    tranche_list = list(structured_deal)
+    annual_IRR = batchIRR([tranche.cashFlow for tranche in tranche_list],
+                          [tranche.rate / 12 for tranche in tranche_list])[1]
+    for tranche, tranche_IRR in zip(tranche_list, annual_IRR):
         # Each value to the dict is a tuple that contains DIRR and AL. The key is the tranche's
         # subordination level.
-        single_res[tranche.subordination] = (tranche_DIRR, AL)
+        single_res[tranche.subordination] = getTrancheMetrics(tranche, tranche_IRR,
+                                                              tranche.averageLife())
     # This resets the StructuredSecurities object.
     # For assets, only default period needs to be reset and that's done in every period 0.
     structured_deal.resetAll()
     return single_res
 
 
-# This simulates out the inner loops when multiprocessing is not used. This carries out the
-# waterfall NSIM times and records the average result.
-def simulateWaterfall(loaded_pool, structured_deal, NSIM):
-    # This list holds the combined results from all the simulations.
-    combined_res_list = []
-    # This loops through the desired number of simulations.
-    for i in range(NSIM):
-        # This runs the waterfall one time.
-        single_res = doMiniWaterfall(loaded_pool, structured_deal)
-        # If any of the tranche's AL is None, then the simulation is considered invalid and not
-        # added to the combined list of results.
-        invalid_AL = any(single_res[tranche.subordination][1] is None
-                         for tranche in structured_deal)
-        # If the simulation has valid AL, then it is added to the combined list of results.
-        if not invalid_AL:
-            combined_res_list.append(single_res)
+# This executes the liability side of the waterfall for many asset paths at once and returns a list
+# with the waterfall metrics of each path, as payLiabilities() would. The paths are padded to the
+# same number of periods, and the waterfall runs over all of them with array operations.
+def payLiabilitiesBatch(asset_paths, structured_deal):
+    # Nothing is paid in period 0, so only the periods after it are needed.
+    num_periods = np.array([len(asset_path) - 1 for asset_path in asset_paths])
+    available = np.zeros((len(asset_paths), num_periods.max(initial=0), 2))
+    for i, asset_path in enumerate(asset_paths):
+        available[i, :num_periods[i]] = np.asarray(asset_path, dtype=float)[1:, :2]
+    # Making payments to the liabilities requires information about the interest payments and
+    # principal payments from the assets.
+    cash_flows, average_life, balance = structured_deal.makeBatchPayments(
+        available[:, :, 1], available[:, :, 0], num_periods)
+    num_paths, num_tranches, num_columns = cash_flows.shape
+    # This calculates the annual IRR of every tranche on every path at once, starting from the
+    # coupons. The padded periods have no cash flow, so they do not change the IRR.
+    tranche_list = list(structured_deal)
+    annual_IRR = batchIRR(cash_flows.reshape(-1, num_columns),
+                          np.tile([tranche.rate / 12 for tranche in tranche_list], num_paths))[1]
+    annual_IRR = annual_IRR.reshape(num_paths, num_tranches)
+    # AL is None for the tranches that are not completely paid off.
+    AL = average_life.tolist()
+    return [{tranche.subordination: getTrancheMetrics(tranche, annual_IRR[i, j],
+                                                      None if balance[i, j] > 0 else AL[i][j])
+             for j, tranche in enumerate(tranche_list)}
+            for i in range(num_paths)]
 
-    # This counts the number of trials with valid Average Life.
-    num_valid_trials = len(combined_res_list)
-    # If there is 0 trial with valid AL, then an error is raised.
-    if num_valid_trials == 0:
-        raise ValueError('The number of trials with valid Average Life is 0.')
-    else:
-        # This prints the number of trials with valid Average Life. This can be helpful information.
-        print('\n{0} out of {1} trials with valid Average Life'.format(num_valid_trials, NSIM))
 
-    # This dict will hold the average result.
-    res = {}
-    for tranche in structured_deal:
-        # s is used just to make the code less cumbersome.
-        s = tranche.subordination
-        # Results from all the simulations will be averaged here.
-        # First item of the tuple is DIRR. Second item is AL.
-        res[s] = (sum(single_res[s][0] for single_res in combined_res_list) / num_valid_trials,
-                  sum(single_res[s][1] for single_res in combined_res_list) / num_valid_trials)
-    return res
+# This returns the DIRR and AL of a tranche from its annual IRR and its AL, which is None if the
+# tranche is not completely paid off.
+def getTrancheMetrics(tranche, tranche_IRR, AL):
+    # This calculates the DIRR for each tranche.
+    tranche_DIRR = tranche.rate - tranche_IRR
+    # This sets DIRR to 0 below a certain threshold, in order to avoid problems when using
+    # DIRR to calculate yield.
+    if tranche_DIRR < (tranche.rate * 10 ** (-6)):
+        tranche_DIRR = 0.0
+    return tranche_DIRR, AL
 
 
-# This is the function that each process executes.
-def doWork(iQueue, oQueue):
-    # This extracts the relevant objects from the input queue tuple.
-    f, args, n = iQueue.get()
-    # This executes the waterfall a number of times and records the results in a list.
-    single_process_res_list = [f(*args) for i in range(n)]
-    # The list of results is put into the output queue.
-    oQueue.put(single_process_res_list)
-
-
-# This executes the inner loops using parallel processes.
-def runSimulationParallel(loaded_pool, structured_deal, NSIM, num_processes):
-    # This is the number simulations allocated to each process.
-    SIM_per_process = math.ceil(NSIM / num_processes)
-    # This is the input queue that feeds parameters to each process.
-    iQueue = multiprocessing.Queue()
-    # This is the output queue that holds the results.
-    oQueue = multiprocessing.Queue()
-
-    # This makes copies of the loaded_pool and structured_deal, so each process can run
-    # simulations on its own copy.
-    pool_copies = [copy.deepcopy(loaded_pool) for i in range(num_processes)]
-    deal_copies = [copy.deepcopy(structured_deal) for i in range(num_processes)]
-    # This fills the input queue.
-    for i in range(num_processes):
-        iQueue.put((doMiniWaterfall, (pool_copies[i], deal_copies[i]), SIM_per_process))
-
-    # This list holds the processes' handles, so they can be terminated later.
-    process_handles = []
-    # This creates the desired number of processes.
-    for i in range(num_processes):
-        # This creates one process and gives it the target function and arguments.
-        p = multiprocessing.Process(target=doWork, args=(iQueue, oQueue))
-        # This adds the process to the list of processes.
-        process_handles.append(p)
-        # This starts the process.
-        p.start()
-
-    # This list holds the combined results.
-    combined_res_list = []
-    while True:
-        # This is blocked until a process provides a list of results.
-        r = oQueue.get()
-        # This lists of results are combined here.
-        combined_res_list.extend(r)
-        # Once the desired number of simulations is completed, the whole procedure ends.
-        # ">=" is used here because when the total number of simulations is not divisible by
-        # the number of processes, each process executing an equal number of simulations
-        # means the final number of simulations would be slightly greater than the
-        # user-specified NSIM.
-        if len(combined_res_list) >= NSIM:
-            # This for-loop terminates the spawned processes.
-            for p in process_handles:
-                p.terminate()
-            break
+# These are the variance reduction methods that can be used in the inner loops. With 'antithetic',
+# the simulations come in pairs drawing antithetic random numbers. With 'control_variate', the
+# averages are adjusted with the pool loss, whose expected value is known exactly.
+_varianceReductions = ('antithetic', 'control_variate')
+
+
+# This returns an empty SimulationStats object for the tranches of the structured deal, set up for
+# the given variance reduction methods. With a QuasiRandomSampler, a ReplicatedStats object holding
+# one SimulationStats object per replicate is returned instead. If the pool's number of defaults
+# is tilted, the results are weighted by their likelihood ratios.
+def newSimulationStats(structured_deal, loaded_pool=None, variance_reduction=(), sampler=None):
+    subordinations = [tranche.subordination for tranche in structured_deal]
+    control_mean = loaded_pool.expectedLoss() if 'control_variate' in variance_reduction else None
+    weighted = loaded_pool is not None and loaded_pool.defaultTilt != 0
+    if sampler is not None:
+        return ReplicatedStats(subordinations, sampler.numReplicates, control_mean, weighted)
+    return SimulationStats(subordinations, control_mean, 'antithetic' in variance_reduction,
+                           weighted)
+
+
+# This is the largest number of paths whose liability side is run at once by runSimulations(). It
+# is even, so that antithetic pairs are never split.
+_liabilityBatchSize = 500
+
+# This is the default number of simulations in each chunk of the inner loop. The chunks do not
+# depend on the number of processes, and their statistics are always merged in chunk order, so
+# results are the same to the last bit with or without multiprocessing. It is even, so that
+# antithetic pairs are never split.
+_chunkSize = 100
+
+
+# This splits simulations start to stop - 1 into chunks. Every chunk boundary is a multiple of
+# chunk_size, so that any range is split the same way as the simulations from 0 on.
+def splitIntoChunks(start, stop, chunk_size):
+    chunks = []
+    chunk_start = start
+    while chunk_start < stop:
+        chunk_stop = min((chunk_start // chunk_size + 1) * chunk_size, stop)
+        chunks.append((chunk_start, chunk_stop))
+        chunk_start = chunk_stop
+    return chunks
+
+
+# This carries out simulations start to stop - 1 and returns the statistics of their results as a
+# SimulationStats object. If asset paths are given, they are those of simulations start to stop - 1,
+# and the liability side is replayed over them instead of simulating the assets again. Otherwise,
+# the random numbers of each simulation are derived from the seed, or taken from the
+# QuasiRandomSampler if one is given, and if new_paths is a list, the asset paths are appended to
+# it so that they can be replayed later. With 'antithetic' variance reduction, start and stop must
+# be even.
+def runSimulations(loaded_pool, structured_deal, start, stop, asset_paths=None, seed=None,
+                   variance_reduction=(), sampler=None, new_paths=None):
+    antithetic = 'antithetic' in variance_reduction
+    control_variate = 'control_variate' in variance_reduction
+    # This holds the statistics of the simulations. Only the simulations with valid AL are added
+    # to the averages; the others are only counted.
+    stats = newSimulationStats(structured_deal, loaded_pool, variance_reduction, sampler)
+    # The simulations are run in batches. The asset side of a batch is simulated path by path, and
+    # then the liability side is run over the whole batch at once.
+    for batch_start in range(start, stop, _liabilityBatchSize):
+        batch_stop = min(batch_start + _liabilityBatchSize, stop)
+        if asset_paths is None:
+            batch = generateAssetPaths(loaded_pool, batch_stop, seed, antithetic, sampler,
+                                       batch_start)
+            if new_paths is not None:
+                new_paths.extend(batch)
+        else:
+            batch = asset_paths[batch_start - start:batch_stop - start]
+        batch_paths = [asset_path for asset_path, weight in batch]
+        weights = [weight for asset_path, weight in batch]
+        res_list = payLiabilitiesBatch(batch_paths, structured_deal)
+        # This records the pool loss of each path as the control variate.
+        losses = [loaded_pool.pathLoss(asset_path) if control_variate else None
+                  for asset_path in batch_paths]
+        # The results are added one at a time, or two at a time for antithetic pairs.
+        if antithetic:
+            for k in range(0, batch_stop - batch_start, 2):
+                stats.addPair(res_list[k], res_list[k + 1], losses[k], losses[k + 1])
+        else:
+            for k in range(batch_stop - batch_start):
+                if sampler is not None:
+                    stats.replicate(sampler.replicateOf(batch_start + k)).addResult(
+                        res_list[k], losses[k], weights[k])
+                else:
+                    stats.addResult(res_list[k], losses[k], weights[k])
+    return stats
+
+
+# This is the smallest effective sample size, as a fraction of the number of valid trials, at
+# which the standard errors of weighted trials are trusted. Below it, the results are dominated by
+# a few trials with large weights.
+_minEffectiveFraction = 0.1
 
-    # This creates a new list by keeping only the results in combined_res_list with non-infinite
-    # AL. This essentially drops the trials with infinite ALs.
-    valid_res_list = [single_res for single_res in combined_res_list
-                      if not any(single_res[tranche.subordination][1] is None
-                                 for tranche in structured_deal)]
+
+# This checks the statistics gathered by the inner loop and reports the number of valid trials.
+# For weighted trials, the effective sample size is reported too, with a warning if it is too
+# small for the standard errors to be trusted.
+def checkSimulationStats(stats):
     # This counts the number of trials with valid Average Life.
-    num_valid_trials = len(valid_res_list)
+    num_valid_trials = stats.validCount
     # If there is 0 trial with valid AL, then an error is raised.
     if num_valid_trials == 0:
         raise ValueError('The number of trials with valid Average Life is 0.')
     else:
         # This prints the number of trials with valid Average Life. This can be helpful information.
-        print('\n{0} out of {1} trials with valid Average Life'.format(num_valid_trials, NSIM))
+        print('\n{0} out of {1} trials with valid Average Life'.format(num_valid_trials,
+                                                                       stats.count))
+        if stats.effectiveCount < num_valid_trials:
+            print('Effective sample size: {0:.1f} of {1} valid trials'.format(
+                stats.effectiveCount, num_valid_trials))
+            if stats.effectiveCount < _minEffectiveFraction * num_valid_trials:
+                logging.warning('The effective sample size is below {0:.0%} of the valid trials, '
+                                'so the averages and their standard errors are unreliable. A '
+                                'smaller default tilt should be used.'.format(
+                                    _minEffectiveFraction))
+    return stats
 
-    # This dict will hold the average result.
-    res = {}
-    for tranche in structured_deal:
-        # s is used just to make the code less cumbersome.
-        s = tranche.subordination
-        # Results from all the simulations will be averaged here.
-        # First item of the tuple is DIRR. Second item is AL.
-        res[s] = \
-            (sum(single_res[s][0] for single_res in valid_res_list) / num_valid_trials,
-             sum(single_res[s][1] for single_res in valid_res_list) / num_valid_trials)
-    return res
+
+# This simulates out the inner loops when multiprocessing is not used. This carries out simulations
+# start to NSIM - 1 of the waterfall and returns the statistics of the results as a SimulationStats
+# object (see runSimulations()). The simulations are split into the same chunks as in
+# runSimulationParallel(), whose statistics are merged in the same order. If asset_paths is a list,
+# it holds the asset paths stored so far (see storeAssetPaths()), which are replayed, and the paths
+# that are simulated are added to it. If by_chunk is True, the statistics of each chunk are returned
+# instead, as a list of (chunk stop, statistics) tuples in chunk order.
+def simulateWaterfall(loaded_pool, structured_deal, NSIM, asset_paths=None, seed=None, start=0,
+                      variance_reduction=(), sampler=None, chunk_size=None, by_chunk=False):
+    chunk_size = checkChunkSize(chunk_size, variance_reduction)
+    chunk_stats_list = []
+    for chunk_start, chunk_stop in splitIntoChunks(start, NSIM, chunk_size):
+        chunk_paths = getStoredAssetPaths(asset_paths, chunk_start, chunk_stop)
+        new_paths = [] if asset_paths is not None and chunk_paths is None else None
+        chunk_stats_list.append((chunk_stop, runSimulations(
+            loaded_pool, structured_deal, chunk_start, chunk_stop, chunk_paths, seed,
+            variance_reduction, sampler, new_paths)))
+        storeAssetPaths(asset_paths, chunk_start, new_paths)
+    if by_chunk:
+        return chunk_stats_list
+    stats = newSimulationStats(structured_deal, loaded_pool, variance_reduction, sampler)
+    for chunk_stop, chunk_stats in chunk_stats_list:
+        stats.merge(chunk_stats)
+    return stats
+
+
+# This returns the stored asset paths of simulations start to stop - 1, or None if some of them
+# have not been simulated yet. asset_paths holds the paths of the simulations from 0 on, in order.
+def getStoredAssetPaths(asset_paths, start, stop):
+    if asset_paths is None or stop > len(asset_paths):
+        return None
+    return asset_paths[start:stop]
+
+
+# This adds new_paths, the asset paths of the simulations from start on, to the stored asset paths.
+# The inner loop always starts from simulation 0, so the stored paths grow only as far as the
+# inner loop has gone, and none is simulated before it is needed.
+def storeAssetPaths(asset_paths, start, new_paths):
+    if asset_paths is not None and new_paths is not None and start <= len(asset_paths):
+        asset_paths.extend(new_paths[len(asset_paths) - start:])
 
 
-# This is the outer loop. It discovers the optimal rates for the tranches.
-def runMonte(loaded_pool, structured_deal, tol, NSIM, num_processes, multi_choice):
-    # This counts the number of outer loop.
-    loop_counter = 0
+# This returns the chunk size to use, which is _chunkSize if chunk_size is None. With 'antithetic'
+# variance reduction, it is rounded up to an even size so that no pair is split.
+def checkChunkSize(chunk_size, variance_reduction=()):
+    if chunk_size is None:
+        chunk_size = _chunkSize
+    if chunk_size < 1:
+        raise ValueError('Exception: chunk_size must be at least 1.')
+    if 'antithetic' in variance_reduction:
+        chunk_size += chunk_size % 2
+    return chunk_size
+
+
+# This is the function that each process executes. The loan pool, the structured deal, the
+# variance reduction methods, and the QuasiRandomSampler, if any, are handed over once when the
+# process starts. After that, each work unit is a small
+# chunk that only holds its index, the tranche rates, the range of simulations to carry out, the
+# seed from which the random numbers of those simulations are derived, whether the asset paths of
+# the simulations are replayed from those the process holds, and whether newly simulated asset paths
+# should be kept so that they can be replayed later. The asset paths never leave the process.
+# If a chunk fails, the exception is put into the output queue in place of its statistics, so that
+# the main process can raise it, and the process moves on to the next chunk.
+def doWork(iQueue, oQueue, loaded_pool, structured_deal, variance_reduction=(), sampler=None):
+    # This holds the asset paths kept by the process, by simulation.
+    kept_paths = {}
     while True:
-        # This calls the proper function to run the inner loops, either with multiprocessing or
-        # without multiprocessing.
-        if multi_choice == '2':
-            res = simulateWaterfall(loaded_pool, structured_deal, NSIM)
-        else:
-            res = runSimulationParallel(loaded_pool, structured_deal, NSIM, num_processes)
-        # These variables are used in calculations for optimizing tranche rates. They are dicts
-        # because there are different values for different tranches.
-        coeff_dict = {'A': 1.2, 'B': 0.8}
-        yield_dict = {}
-        old_rate_dict = {}
-        new_rate_dict = {}
-        notional_dict = {}
-        diff_dict = {}
-        for tranche in structured_deal:
-            # s is used just to make the code less cumbersome.
-            s = tranche.subordination
-            # This calculates the yield.
-            yield_dict[s] = calculateYield(res[s][0], res[s][1])
-            # This contains the old tranche rates.
-            old_rate_dict[s] = tranche.rate
-            # This calculates the new tranche rates.
-            new_rate_dict[s] = old_rate_dict[s] + coeff_dict[s] * (yield_dict[s] - old_rate_dict[s])
-            # This contains the notional values of the tranches.
-            notional_dict[s] = tranche.notional
-            # This is one part of the formula for checking convergence.
-            diff_dict[s] = notional_dict[s] * abs(old_rate_dict[s] - new_rate_dict[s]) / \
-                           old_rate_dict[s]
-        # This is the other part.
-        diff = (diff_dict['A'] + diff_dict['B']) / (notional_dict['A'] + notional_dict['B'])
-        loop_counter += 1
-        # This prints the temporary results after each outer loop.
-        print('{} outer loops complete.'.format(loop_counter))
-        print('CLass A rate: {:.2f}%'.format(old_rate_dict['A'] * 100))
-        print('Class B rate: {:.2f}%'.format(old_rate_dict['B'] * 100))
-        print('diff: {:.5f}'.format(diff))
-        # If diff is less than tol, then the simulation is completed.
-        if diff < tol:
-            logging.info('diff is lower than tolerance. Simulation completes.')
+        # This is blocked until a work unit is available.
+        work_unit = iQueue.get()
+        # None tells the process to stop.
+        if work_unit is None:
             break
-        # Otherwise, we update the tranche rates and repeat the process.
-        else:
+        chunk_index, rate_dict, start, stop, seed, replay, keep_paths = work_unit
+        start_time = time.time()
+        new_paths = [] if keep_paths else None
+        try:
+            # This updates the rates of the process's own copy of the tranches.
+            for tranche in structured_deal:
+                tranche.rate = rate_dict[tranche.subordination]
+            chunk_paths = [kept_paths[i] for i in range(start, stop)] if replay else None
+            # This executes the waterfall a number of times and records the statistics of the
+            # results. If asset paths are replayed, only the liability side is run over them.
+            chunk_stats = runSimulations(loaded_pool, structured_deal, start, stop, chunk_paths,
+                                         seed, variance_reduction, sampler, new_paths)
+            if keep_paths:
+                kept_paths.update(zip(range(start, stop), new_paths))
+        except Exception as e:
+            logging.exception('Simulations {0} to {1} failed.'.format(start, stop - 1))
+            chunk_stats = e
+        # The statistics are put into the output queue, along with the chunk index, the name of
+        # the process, and the time it took.
+        oQueue.put((chunk_index, multiprocessing.current_process().name,
+                    time.time() - start_time, chunk_stats))
+
+
+# This returns the index of the process that holds the asset paths of simulations start to
+# stop - 1, or None if some of them have not been simulated yet or they are not all held by the
+# same process. path_owners holds the index of the process that holds the path of each simulation
+# from 0 on, in order.
+def getPathOwner(path_owners, start, stop):
+    if path_owners is None or stop > len(path_owners):
+        return None
+    owners = set(path_owners[start:stop])
+    return owners.pop() if len(owners) == 1 else None
+
+
+# This records that the process of the given index holds the asset paths of simulations start to
+# stop - 1. As with storeAssetPaths(), the records only grow as far as the inner loop has gone.
+def storePathOwners(path_owners, start, stop, process_index):
+    if path_owners is not None and start <= len(path_owners):
+        path_owners[start:stop] = [process_index] * (stop - start)
+
+
+# This is the number of chunks each process is given ahead, so that it never waits for the main
+# process to send the next one.
+_chunksAhead = 2
+
+
+# This executes the inner loops using the worker processes, which are created once by runMonte().
+# The simulations are split into chunks by splitIntoChunks(). Each process is given _chunksAhead
+# chunks at first and then a new one each time it sends back a result, so faster processes end up
+# doing more chunks. The chunks do not depend on the number of processes, and the random numbers
+# of each simulation are derived from the seed. Simulations start to NSIM - 1 are carried out, and
+# the statistics of the chunks are merged in chunk order and returned as a SimulationStats object,
+# so the results are exactly those of simulateWaterfall(). If path_owners is a list, the asset
+# paths are reused as in simulateWaterfall(), but each process keeps the paths it simulates, and
+# path_owners only records which process holds the path of each simulation (see getPathOwner()).
+# A chunk whose paths are all held by one process is given to that process, so the paths are never
+# sent between processes. If by_chunk is True, the statistics of each chunk are returned instead,
+# as in simulateWaterfall().
+def runSimulationParallel(workers, structured_deal, NSIM, chunk_size=None, seed=None, start=0,
+                          loaded_pool=None, variance_reduction=(), sampler=None, path_owners=None,
+                          by_chunk=False):
+    chunk_size = checkChunkSize(chunk_size, variance_reduction)
+    # This holds the current tranche rates, which is all the processes need to know about the
+    # structured deal.
+    rate_dict = {tranche.subordination: tranche.rate for tranche in structured_deal}
+    # Together the chunks cover exactly simulations start to NSIM - 1.
+    chunks = splitIntoChunks(start, NSIM, chunk_size)
+    num_chunks = len(chunks)
+    # These hold the chunks waiting for each process, whose asset paths it holds, and the chunks
+    # that any process can take.
+    own_chunks = [collections.deque() for i in range(len(workers))]
+    any_chunks = collections.deque()
+    for chunk_index, (chunk_start, chunk_stop) in enumerate(chunks):
+        owner = getPathOwner(path_owners, chunk_start, chunk_stop)
+        (any_chunks if owner is None else own_chunks[owner]).append(chunk_index)
+    # This dict holds the index of the process each chunk was given to.
+    chunk_processes = {}
+
+    # This gives the next chunk waiting for it to the process of the given index, if any.
+    def submitNextChunk(process_index):
+        waiting_chunks = own_chunks[process_index] or any_chunks
+        if waiting_chunks:
+            chunk_index = waiting_chunks.popleft()
+            replay = waiting_chunks is own_chunks[process_index]
+            workers.submit((chunk_index, rate_dict) + chunks[chunk_index] +
+                           (seed, replay, path_owners is not None and not replay), process_index)
+            chunk_processes[chunk_index] = process_index
+
+    for i in range(_chunksAhead):
+        for process_index in range(len(workers)):
+            submitNextChunk(process_index)
+
+    # This dict holds the statistics of each chunk, so they can be merged in chunk order.
+    chunk_stats_dict = {}
+    # This dict holds the number of simulations and the time spent by each process.
+    process_stats = {}
+    # This holds the exception of the first chunk that failed, if any.
+    error = None
+    for i in range(num_chunks):
+        # This is blocked until a process provides the statistics of a chunk.
+        chunk_index, process_name, run_time, chunk_stats = workers.getResult()
+        submitNextChunk(chunk_processes[chunk_index])
+        # The results of the other chunks are still collected, so that none is left in the queue.
+        if isinstance(chunk_stats, Exception):
+            error = error or chunk_stats
+            continue
+        chunk_stats_dict[chunk_index] = chunk_stats
+        num_sims, total_time = process_stats.get(process_name, (0, 0.0))
+        process_stats[process_name] = (num_sims + chunk_stats.count, total_time + run_time)
+    if error is not None:
+        raise error
+    for i in range(num_chunks):
+        storePathOwners(path_owners, chunks[i][0], chunks[i][1], chunk_processes[i])
+    # This reports the throughput of each process, which shows how the load was balanced.
+    logging.info('Simulations per second by process: {}'.format(', '.join(
+        '{0}: {1:.1f} ({2} sims)'.format(name, num_sims / max(total_time, 10 ** -9), num_sims)
+        for name, (num_sims, total_time) in sorted(process_stats.items()))))
+    if by_chunk:
+        return [(chunks[i][1], chunk_stats_dict[i]) for i in range(num_chunks)]
+    # This merges the statistics of all the chunks.
+    stats = newSimulationStats(structured_deal, loaded_pool, variance_reduction, sampler)
+    for i in range(num_chunks):
+        stats.merge(chunk_stats_dict[i])
+    return stats
+
+
+# This checks whether the standard errors of the averages are within target_std_error, a tuple
+# holding the targets for DIRR and AL, for every tranche. The standard errors of weighted trials
+# are not trusted while the effective sample size is too small.
+def isPreciseEnough(stats, target_std_error):
+    if stats.effectiveCount < _minEffectiveFraction * stats.validCount:
+        return False
+    return all(std_error[0] <= target_std_error[0] and std_error[1] <= target_std_error[1]
+               for std_error in stats.stdErrors().values())
+
+
+# This runs the inner loop in batches until the averages are precise enough. simulate(start, stop)
+# carries out simulations start to stop - 1 and returns the statistics of each chunk, as
+# simulateWaterfall() does with by_chunk. Batches of batch_size simulations are carried out until
+# the standard errors are within target_std_error or NSIM simulations have been carried out. The
+# standard errors are checked after each chunk, in chunk order, so the inner loop stops at the same
+# chunk whatever the batch size, as long as it is a multiple of the chunk size. The chunks of a
+# batch that come after it are dropped. If target_std_error is None, all NSIM simulations are
+# carried out at once.
+def simulateAdaptive(simulate, structured_deal, NSIM, target_std_error=None, batch_size=_chunkSize,
+                     loaded_pool=None, variance_reduction=(), sampler=None):
+    stats = newSimulationStats(structured_deal, loaded_pool, variance_reduction, sampler)
+    if target_std_error is None:
+        for chunk_stop, chunk_stats in simulate(0, NSIM):
+            stats.merge(chunk_stats)
+        return checkSimulationStats(stats)
+    if batch_size < 1:
+        raise ValueError('Exception: batch_size must be at least 1.')
+    # Antithetic pairs must not be split between batches.
+    if 'antithetic' in variance_reduction:
+        batch_size += batch_size % 2
+    num_sims = 0
+    precise_enough = False
+    while num_sims < NSIM and not precise_enough:
+        for chunk_stop, chunk_stats in simulate(num_sims, min(num_sims + batch_size, NSIM)):
+            stats.merge(chunk_stats)
+            num_sims = chunk_stop
+            # At least two valid trials are needed to estimate the standard errors.
+            if stats.validCount > 1 and isPreciseEnough(stats, target_std_error):
+                precise_enough = True
+                break
+    logging.info('Inner loop stopped after {0} of at most {1} simulations.'.format(num_sims, NSIM))
+    return checkSimulationStats(stats)
+
+
+# This is the outer loop. It discovers the optimal rates for the tranches. If reuse_assets is True,
+# the asset side is simulated only once and the same asset paths are replayed in every outer loop,
+# since only the tranche rates change between outer loops. Each asset path is simulated the first
+# time it is needed, so the paths beyond those reached by the inner loops are never simulated or
+# stored. All random numbers are derived from the seed, so a run can be reproduced by giving the
+# same seed. If seed is None, a new one is drawn.
+# The inner loop is split into chunks of chunk_size simulations, _chunkSize by default, with or
+# without multiprocessing, so a run gives the same results to the last bit for any number of
+# processes, as long as the seed and chunk_size are the same.
+# If target_std_error is given, NSIM is only the maximum number of simulations of each inner loop,
+# which stops once the standard errors of DIRR and AL are within target_std_error (see
+# simulateAdaptive()). The target is loosened in proportion to how far the outer loop is from
+# convergence, so early outer loops only need a few batches of simulations. With multiprocessing,
+# each batch holds one chunk per process by default, so that none of them is idle, and the
+# standard errors are still checked after each chunk, so the inner loop stops at the same
+# simulation for any number of processes.
+# variance_reduction holds any of the methods in _varianceReductions. The variance ratio achieved
+# by them is reported after each outer loop.
+# If quasi_random is 'sobol' or 'lhs', the default periods are drawn from scrambled Sobol or Latin
+# hypercube points instead of pseudo-random numbers, spread over num_replicates independent
+# replicates whose spread gives the standard errors. This requires 'time' default sampling.
+# If default_tilt is given, the number of defaults is tilted so that its expected value is
+# default_tilt standard deviations higher, and the results are weighted by their likelihood ratios
+# (importance sampling, see Loan.defaultCountTwist()). This makes the rare simulations in which
+# the senior tranches take losses more frequent. The effective sample size is reported, and it
+# falls quickly as the tilt grows. It cannot be combined with variance_reduction.
+# The tranche rates are updated by rate_solver, a RateSolver object, which by default is the damped
+# fixed-point relaxation. It works for any number of tranches.
+def runMonte(loaded_pool, structured_deal, tol, NSIM, num_processes, multi_choice,
+             reuse_assets=True, chunk_size=None, seed=None, target_std_error=None,
+             batch_size=None, variance_reduction=(), quasi_random=None, num_replicates=8,
+             default_tilt=None, rate_solver=None):
+    if rate_solver is None:
+        rate_solver = RelaxationSolver()
+    # Error is raised for unknown variance reduction methods, or for an odd number of antithetic
+    # simulations.
+    if any(method not in _varianceReductions for method in variance_reduction):
+        raise ValueError('Exception: This is not a valid variance reduction method.')
+    antithetic = 'antithetic' in variance_reduction
+    if antithetic and NSIM % 2:
+        raise ValueError('Exception: NSIM must be even for antithetic simulations.')
+    # This sets up the quasi-random sampler, which draws one number per loan and simulation.
+    sampler = None
+    if quasi_random is not None:
+        if antithetic or loaded_pool.defaultSampling != 'time':
+            raise ValueError('Exception: Quasi-random sampling requires time default sampling '
+                             'and cannot be combined with antithetic simulations.')
+        sampler = QuasiRandomSampler(quasi_random, len(loaded_pool), num_replicates,
+                                     -(-NSIM // num_replicates))
+    # This tilts the probabilities of default for the whole run. The original tilt is restored at
+    # the end.
+    original_tilt = loaded_pool.defaultTilt
+    # With multiprocessing, the processes are started only once for all outer loops. Each one
+    # gets its own copy of the loan pool and the structured deal at start-up.
+    workers = None
+    # Whatever happens in the outer loop, the processes are stopped, the shared memory is freed,
+    # and the original tilt is restored.
+    try:
+        if default_tilt is not None:
+            if variance_reduction:
+                raise ValueError('Exception: Importance sampling cannot be combined with variance '
+                                 'reduction.')
+            loaded_pool.defaultTilt = default_tilt
+        # This draws a seed if none is given and reports it, so the run can be reproduced later.
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        logging.info('Random seed: {}'.format(seed))
+        # This counts the number of outer loop, and the number of times the inner loop is run.
+        loop_counter = 0
+        num_inner_loops = 0
+        # This holds the diff of the previous outer loop, which is unknown for the first one.
+        diff = math.inf
+        # This holds the asset paths shared by all outer loops, which are added as they are
+        # simulated. With multiprocessing, each process keeps the paths it simulates, and this
+        # only records which process holds each of them (see runSimulationParallel()).
+        asset_paths = [] if reuse_assets else None
+        if multi_choice != '2':
+            # The static loan data of an ArrayLoanPool is placed in shared memory, so the processes
+            # attach to it instead of each holding a copy.
+            if isinstance(loaded_pool, ArrayLoanPool):
+                loaded_pool.shareStaticColumns()
+            workers = WorkerPool(doWork, num_processes, loaded_pool, structured_deal,
+                                 variance_reduction, sampler)
+        # By default, each batch of the adaptive inner loop holds one chunk per process.
+        if batch_size is None:
+            batch_size = checkChunkSize(chunk_size, variance_reduction) * (
+                1 if multi_choice == '2' else num_processes)
+        while True:
+            # This calls the proper function to run the inner loops, either with multiprocessing or
+            # without multiprocessing.
+            # When the assets are simulated again, each outer loop gets its own random numbers.
+            loop_seed = seed if reuse_assets else [seed, loop_counter]
+            if multi_choice == '2':
+                simulate = lambda start, stop: simulateWaterfall(
+                    loaded_pool, structured_deal, stop, asset_paths, loop_seed, start,
+                    variance_reduction, sampler, chunk_size, True)
+            else:
+                simulate = lambda start, stop: runSimulationParallel(
+                    workers, structured_deal, stop, chunk_size, loop_seed, start, loaded_pool,
+                    variance_reduction, sampler, asset_paths, True)
+            # The further the previous outer loop was from convergence, the looser the target.
+            loop_target = None
+            if target_std_error is not None:
+                loop_target = tuple(target * max(1.0, diff / tol) for target in target_std_error)
+
+            # This runs the inner loop at the given tranche rates and returns the yields, along with
+            # the statistics. Within an outer loop, it always draws the same random numbers.
+            def evaluateRates(rate_dict):
+                nonlocal num_inner_loops
+                num_inner_loops += 1
+                for tranche in structured_deal:
+                    tranche.rate = rate_dict[tranche.subordination]
+                rate_stats = simulateAdaptive(simulate, structured_deal, NSIM, loop_target,
+                                              batch_size, loaded_pool, variance_reduction, sampler)
+                rate_res = rate_stats.averages()
+                return {s: calculateYield(rate_res[s][0], rate_res[s][1]) for s in rate_res}, \
+                    rate_stats
+
+            # These variables are used in calculations for optimizing tranche rates. They are dicts
+            # because there are different values for different tranches.
+            old_rate_dict = {tranche.subordination: tranche.rate for tranche in structured_deal}
+            notional_dict = {tranche.subordination: tranche.notional for tranche in structured_deal}
+            yield_dict, stats = evaluateRates(old_rate_dict)
+            # First item of each tuple is the average DIRR. Second item is the average AL.
+            res = stats.averages()
+            std_errors = stats.stdErrors()
+            variance_ratios = stats.varianceRatios()
+            # This calculates the new tranche rates. The solver may run the inner loop at other
+            # rates.
+            new_rate_dict = rate_solver.nextRates(old_rate_dict, yield_dict,
+                                                  lambda rate_dict: evaluateRates(rate_dict)[0])
+            for tranche in structured_deal:
+                tranche.rate = old_rate_dict[tranche.subordination]
+            # This is the formula for checking convergence: the change in rates relative to the old
+            # rates, weighted by notional.
+            diff = sum(notional_dict[s] * abs(old_rate_dict[s] - new_rate_dict[s]) /
+                       old_rate_dict[s] for s in old_rate_dict) / sum(notional_dict.values())
+            loop_counter += 1
+            # This prints the temporary results after each outer loop.
+            print('{} outer loops complete.'.format(loop_counter))
+            for tranche in structured_deal:
+                s = tranche.subordination
+                print('Class {0} rate: {1:.2f}%'.format(s, old_rate_dict[s] * 100))
+            print('diff: {:.5f}'.format(diff))
             for tranche in structured_deal:
                 s = tranche.subordination
-                tranche.rate = new_rate_dict[s]
+                logging.info('Class {0} standard errors: DIRR {1:.2f}bps, AL {2:.2f} months'.format(
+                    s, std_errors[s][0] * 10000, std_errors[s][1]))
+                if variance_reduction or sampler is not None or default_tilt is not None:
+                    logging.info('Class {0} variance ratios: DIRR {1:.2f}, AL {2:.2f}'.format(
+                        s, variance_ratios[s][0], variance_ratios[s][1]))
+            # If diff is less than tol, then the simulation is completed.
+            if diff < tol:
+                logging.info('diff is lower than tolerance. Simulation completes.')
+                print('Converged in {0} outer loops ({1} inner loops).'.format(loop_counter,
+                                                                             num_inner_loops))
+                break
+            # Otherwise, we update the tranche rates and repeat the process.
+            else:
+                for tranche in structured_deal:
+                    s = tranche.subordination
+                    tranche.rate = new_rate_dict[s]
+    except BaseException:
+        # The processes are terminated right away rather than left to finish their work units.
+        if workers is not None:
+            workers.terminate()
+        raise
+    finally:
+        if workers is not None:
+            workers.close()
+        if isinstance(loaded_pool, ArrayLoanPool):
+            loaded_pool.releaseSharedMemory()
+        loaded_pool.defaultTilt = original_tilt
     # This prints the final results.
     for tranche in structured_deal:
         s = tranche.subordination
@@ -293,6 +749,11 @@ def runMonte(loaded_pool, structured_deal, tol, NSIM, num_processes, multi_choic
         print('DIRR: {:.2f}bps'.format(res[s][0] * 10000))
         print('Rating: {}'.format(getRating(res[s][0])))
         print('WAL: {:.2f} months'.format(res[s][1]))
+        print('Standard errors: DIRR {0:.2f}bps, WAL {1:.2f} months'.format(
+            std_errors[s][0] * 10000, std_errors[s][1]))
+        if variance_reduction or sampler is not None or default_tilt is not None:
+            print('Variance ratios: DIRR {0:.2f}, WAL {1:.2f}'.format(
+                variance_ratios[s][0], variance_ratios[s][1]))
 
 
 # This method helps to calculate yield using DIRR and AL.
@@ -319,7 +780,12 @@ def main():
     # This sets the logging level so we get helpful messages throughout the process.
     logging.getLogger().setLevel(logging.INFO)
     # This loads the 1500 loans from Loans.csv and returns a LoanPool object containing the loans.
-    loaded_pool = loadAssets()
+    # The loans are stored as columns, which keeps memory and runtime low for large pools.
+    loaded_pool = loadAssets(columnar=True)
+    # This samples each loan's default period once at the start of every simulation instead of
+    # checking for default period by period. Both give the same distribution of defaults, but
+    # the former needs one random number per loan rather than one per loan per period.
+    loaded_pool.defaultSampling = 'time'
     # This prompts user to choose to run simulations either with multiprocessing or without
     # multiprocessing.
     multi_choice = '0'
@@ -351,9 +817,32 @@ def main():
     tol = 0.005
     NSIM = 20
     num_processes = 20
+    # A fixed seed makes the results reproducible, whatever the number of processes.
+    seed = 20201203
+    # If a target standard error for (DIRR, AL) is given, e.g. (0.00001, 0.01), NSIM becomes the
+    # maximum number of simulations and each inner loop stops once the target is reached.
+    target_std_error = None
+    # Variance reduction methods, e.g. ('antithetic', 'control_variate'), can be added here.
+    variance_reduction = ()
+    # Quasi-random sampling of the default periods, either 'sobol' or 'lhs', can be chosen here.
+    quasi_random = None
+    # Importance sampling of the number of defaults can be turned on with a default tilt, the
+    # number of standard deviations by which the expected number of defaults is raised.
+    default_tilt = None
+    # The tranche rates may also be updated by SecantSolver(), AndersonSolver(), or
+    # NewtonSolver() from solver.rate_solver.
+    rate_solver = RelaxationSolver()
+    # This runs the waterfall of the first simulation once through the waterfall engine, and
+    # writes it to Assets.csv and Liabilities.csv at the current working directory, as in parts 1
+    # and 2. The Monte Carlo simulations below run the same waterfall over many paths at once
+    # with StructuredSecurities.makeBatchPayments(), which only keeps the metrics.
+    doWaterfall(loaded_pool, structured_deal, CSVSink(), getGenerator(seed, 0))
     # This carries out the simulation and keeps track of the runtime.
     with Timer('test1'):
-        runMonte(loaded_pool, structured_deal, tol, NSIM, num_processes, multi_choice)
+        runMonte(loaded_pool, structured_deal, tol, NSIM, num_processes, multi_choice,
+                 seed=seed, target_std_error=target_std_error,
+                 variance_reduction=variance_reduction, quasi_random=quasi_random,
+                 default_tilt=default_tilt, rate_solver=rate_solver)
 
     # Running NSIM = 20 for the inner loop takes about 280 seconds without multiprocessing.
     # Therefore, I did not attempt NSIM = 2000. Running NSIM = 2000 with 20 processes took about
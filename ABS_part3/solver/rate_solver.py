@@ -0,0 +1,120 @@
+'''
+This module contains the RateSolver base class and the solvers derived from it, which update the
+tranche rates in the outer loop of the Monte Carlo simulation. The rates have converged once every
+tranche's rate equals the yield that the simulation gives for it.
+'''
+import numpy as np
+import logging
+
+
+# This is the RateSolver base class. Rates and yields are dicts keyed by tranche subordination, so
+# a solver works for any number of tranches. Derived classes implement _step(), which works on
+# numpy arrays in the order of the sorted subordination levels.
+class RateSolver(object):
+    # This returns the new rates, given the current rates and their yields. evaluate(rate_dict)
+    # runs the inner loop at other rates and returns their yield dict, for solvers that need it.
+    def nextRates(self, rate_dict, yield_dict, evaluate=None):
+        subordinations = sorted(rate_dict)
+        rates = np.array([rate_dict[s] for s in subordinations])
+        yields = np.array([yield_dict[s] for s in subordinations])
+
+        # This wraps evaluate() so that it works on arrays as well.
+        def evaluateArray(i_rates):
+            i_yield_dict = evaluate(dict(zip(subordinations, i_rates)))
+            return np.array([i_yield_dict[s] for s in subordinations])
+
+        new_rates = self._step(subordinations, rates, yields, evaluateArray)
+        return dict(zip(subordinations, new_rates))
+
+    # This returns the new rates. It must be implemented by the derived classes.
+    def _step(self, subordinations, rates, yields, evaluate):
+        raise NotImplementedError()
+
+
+# This is the damped fixed-point relaxation: each rate moves towards its yield by a coefficient
+# times the gap. Tranches without a coefficient of their own use default_coeff.
+class RelaxationSolver(RateSolver):
+    # This initializes an instance of the class. By default, the coefficients are those tuned for
+    # the two tranches 'A' and 'B'.
+    def __init__(self, coeff_dict=None, default_coeff=1.0):
+        self._coeffDict = {'A': 1.2, 'B': 0.8} if coeff_dict is None else coeff_dict
+        self._defaultCoeff = default_coeff
+
+    # This moves each rate towards its yield.
+    def _step(self, subordinations, rates, yields, evaluate):
+        coeffs = np.array([self._coeffDict.get(s, self._defaultCoeff) for s in subordinations])
+        return rates + coeffs * (yields - rates)
+
+
+# This applies the secant method to each tranche's gap between yield and rate, using the rates and
+# yields of the previous outer loop. The first step, and any step the secant method cannot take,
+# is a relaxation step.
+class SecantSolver(RelaxationSolver):
+    # This initializes an instance of the class. The coefficients are used for relaxation steps.
+    def __init__(self, coeff_dict=None, default_coeff=1.0):
+        super(SecantSolver, self).__init__(coeff_dict, default_coeff)
+        self._lastRates = None
+        self._lastGaps = None
+
+    # This takes a secant step for every tranche for which it is possible.
+    def _step(self, subordinations, rates, yields, evaluate):
+        new_rates = super(SecantSolver, self)._step(subordinations, rates, yields, evaluate)
+        gaps = yields - rates
+        if self._lastRates is not None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                secant_rates = rates - gaps * (rates - self._lastRates) / (gaps - self._lastGaps)
+            usable = np.isfinite(secant_rates) & (secant_rates > 0)
+            new_rates = np.where(usable, secant_rates, new_rates)
+        self._lastRates, self._lastGaps = rates, gaps
+        return new_rates
+
+
+# This is Anderson acceleration of the fixed-point map from rates to yields. The new rates combine
+# the last depth + 1 outer loops so as to minimize the gap between yields and rates. The first
+# step is a relaxation step.
+class AndersonSolver(RelaxationSolver):
+    # This initializes an instance of the class. The coefficients are used for the first step.
+    def __init__(self, depth=2, coeff_dict=None, default_coeff=1.0):
+        super(AndersonSolver, self).__init__(coeff_dict, default_coeff)
+        self._depth = depth
+        # These hold the rates and the gaps of the previous outer loops.
+        self._rateHistory = []
+        self._gapHistory = []
+
+    # This takes an Anderson step over the outer loops kept in the history.
+    def _step(self, subordinations, rates, yields, evaluate):
+        gaps = yields - rates
+        self._rateHistory = (self._rateHistory + [rates])[-(self._depth + 1):]
+        self._gapHistory = (self._gapHistory + [gaps])[-(self._depth + 1):]
+        if len(self._rateHistory) == 1:
+            return super(AndersonSolver, self)._step(subordinations, rates, yields, evaluate)
+        # The columns are the changes in rates and gaps between consecutive outer loops.
+        delta_rates = np.diff(np.array(self._rateHistory), axis=0).T
+        delta_gaps = np.diff(np.array(self._gapHistory), axis=0).T
+        gamma = np.linalg.lstsq(delta_gaps, gaps, rcond=None)[0]
+        return rates + gaps - (delta_rates + delta_gaps) @ gamma
+
+
+# This is Newton's method on the gaps between yields and rates. The Jacobian is estimated by finite
+# differences: the inner loop is run again once per tranche, with that tranche's rate raised by
+# step. Since the inner loop draws the same random numbers within an outer loop, the differences
+# are not swamped by simulation noise. If the Jacobian is singular, a relaxation step is taken.
+class NewtonSolver(RelaxationSolver):
+    # This initializes an instance of the class. The coefficients are used for relaxation steps.
+    def __init__(self, step=10 ** -4, coeff_dict=None, default_coeff=1.0):
+        super(NewtonSolver, self).__init__(coeff_dict, default_coeff)
+        self._stepSize = step
+
+    # This takes a Newton step with the Jacobian estimated by finite differences.
+    def _step(self, subordinations, rates, yields, evaluate):
+        gaps = yields - rates
+        jacobian = np.empty((len(rates), len(rates)))
+        for j in range(len(rates)):
+            bumped_rates = rates.copy()
+            bumped_rates[j] += self._stepSize
+            jacobian[:, j] = (evaluate(bumped_rates) - bumped_rates - gaps) / self._stepSize
+        try:
+            return rates - np.linalg.solve(jacobian, gaps)
+        except np.linalg.LinAlgError:
+            logging.warning('The Jacobian of the yields is singular. A relaxation step is taken.')
+            return super(NewtonSolver, self)._step(subordinations, rates, yields, evaluate)
@@ -0,0 +1,439 @@
+'''
+This module contains the RunningStats class, which keeps the count, mean, variance, minimum and
+maximum of a stream of values, the WeightedStats class, which does the same for a stream of
+weighted values, the RunningCovariance class, which keeps the covariance of a
+stream of pairs of values, and the SimulationStats class, which keeps them for the DIRR and AL of
+every tranche over a stream of simulations. The ReplicatedStats class combines the SimulationStats
+of independent replicates of a randomized quasi-Monte Carlo simulation.
+'''
+import math
+
+
+# The mean and variance are updated one value at a time with Welford's method, so the values
+# themselves never need to be stored. Two instances can be merged, which lets each process keep
+# its own statistics and send them back instead of the individual values.
+class RunningStats(object):
+    # This initializes an instance of the class with no values.
+    def __init__(self):
+        self._count = 0
+        self._mean = 0.0
+        # This is the sum of squared deviations from the mean.
+        self._M2 = 0.0
+        self._min = math.inf
+        self._max = -math.inf
+
+    # This adds one value.
+    def add(self, value):
+        self._count += 1
+        delta = value - self._mean
+        self._mean += delta / self._count
+        self._M2 += delta * (value - self._mean)
+        self._min = min(self._min, value)
+        self._max = max(self._max, value)
+
+    # This adds the values of another RunningStats object to this one.
+    def merge(self, other):
+        if other._count == 0:
+            return
+        count = self._count + other._count
+        delta = other._mean - self._mean
+        self._mean += delta * other._count / count
+        self._M2 += other._M2 + delta ** 2 * self._count * other._count / count
+        self._count = count
+        self._min = min(self._min, other._min)
+        self._max = max(self._max, other._max)
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def mean(self):
+        return self._mean
+
+    @property
+    def min(self):
+        return self._min
+
+    @property
+    def max(self):
+        return self._max
+
+    # This returns the sample variance, which is 0 until there are at least 2 values.
+    @property
+    def variance(self):
+        return self._M2 / (self._count - 1) if self._count > 1 else 0.0
+
+    # This returns the standard error of the mean.
+    @property
+    def stdError(self):
+        return math.sqrt(self.variance / self._count) if self._count > 0 else math.inf
+
+
+# Each value comes with a weight, e.g. the likelihood ratio of an importance-sampled simulation.
+# The mean is the weighted mean normalized by the sum of the weights, and its standard error is
+# estimated with the delta method. Only sums are kept, so two instances are merged by adding them.
+class WeightedStats(object):
+    # This initializes an instance of the class with no values.
+    def __init__(self):
+        self._count = 0
+        # These are the sums of the weights, and of the weights times the values and the squared
+        # values. The second set is the same with squared weights.
+        self._W = 0.0
+        self._WX = 0.0
+        self._WXX = 0.0
+        self._W2 = 0.0
+        self._W2X = 0.0
+        self._W2XX = 0.0
+        self._min = math.inf
+        self._max = -math.inf
+
+    # This adds one value with its weight.
+    def add(self, value, weight=1.0):
+        self._count += 1
+        self._W += weight
+        self._WX += weight * value
+        self._WXX += weight * value ** 2
+        self._W2 += weight ** 2
+        self._W2X += weight ** 2 * value
+        self._W2XX += weight ** 2 * value ** 2
+        self._min = min(self._min, value)
+        self._max = max(self._max, value)
+
+    # This adds the values of another WeightedStats object to this one.
+    def merge(self, other):
+        self._count += other._count
+        self._W += other._W
+        self._WX += other._WX
+        self._WXX += other._WXX
+        self._W2 += other._W2
+        self._W2X += other._W2X
+        self._W2XX += other._W2XX
+        self._min = min(self._min, other._min)
+        self._max = max(self._max, other._max)
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def mean(self):
+        return self._WX / self._W if self._W > 0 else 0.0
+
+    @property
+    def min(self):
+        return self._min
+
+    @property
+    def max(self):
+        return self._max
+
+    # This returns the effective sample size, i.e. the number of unweighted values that would give
+    # about the same precision. It is much smaller than the count when a few weights dominate.
+    @property
+    def effectiveCount(self):
+        return self._W ** 2 / self._W2 if self._W2 > 0 else 0.0
+
+    # This returns the weighted variance, an estimate of the variance of the unweighted values.
+    @property
+    def variance(self):
+        return max(0.0, self._WXX / self._W - self.mean ** 2) if self._W > 0 else 0.0
+
+    # This returns the standard error of the mean.
+    @property
+    def stdError(self):
+        if self._W == 0:
+            return math.inf
+        mean = self.mean
+        return math.sqrt(max(0.0, self._W2XX - 2 * mean * self._W2X + mean ** 2 * self._W2)) / \
+            self._W
+
+
+# The covariance is updated one pair at a time in the same way as the variance in RunningStats,
+# and two instances can be merged as well.
+class RunningCovariance(object):
+    # This initializes an instance of the class with no values.
+    def __init__(self):
+        self._count = 0
+        self._meanX = 0.0
+        self._meanY = 0.0
+        # This is the sum of the products of the deviations from the means.
+        self._C = 0.0
+
+    # This adds one pair of values.
+    def add(self, x, y):
+        self._count += 1
+        delta_x = x - self._meanX
+        self._meanX += delta_x / self._count
+        self._meanY += (y - self._meanY) / self._count
+        self._C += delta_x * (y - self._meanY)
+
+    # This adds the pairs of another RunningCovariance object to this one.
+    def merge(self, other):
+        if other._count == 0:
+            return
+        count = self._count + other._count
+        delta_x = other._meanX - self._meanX
+        delta_y = other._meanY - self._meanY
+        self._C += other._C + delta_x * delta_y * self._count * other._count / count
+        self._meanX += delta_x * other._count / count
+        self._meanY += delta_y * other._count / count
+        self._count = count
+
+    # This returns the sample covariance, which is 0 until there are at least 2 pairs.
+    @property
+    def covariance(self):
+        return self._C / (self._count - 1) if self._count > 1 else 0.0
+
+
+# A simulation is valid if the AL of every tranche is defined. Only valid simulations are added to
+# the statistics, while invalid ones are only counted.
+# Two variance reduction methods are supported. If control_mean is given, a control variate whose
+# expected value is control_mean is recorded along with each result, and the averages are adjusted
+# by how far the control variate's average is from its expected value. If antithetic is True, the
+# simulations come in antithetic pairs added with addPair(), and each pair counts as one
+# observation. Either way, the results of the single simulations are also kept, so the variance
+# of plain Monte Carlo can be compared with the variance achieved.
+# If weighted is True, each simulation comes with a weight, such as its likelihood ratio under
+# importance sampling, and the averages are weighted. Weights cannot be combined with the
+# variance reduction methods.
+class SimulationStats(object):
+    # This initializes an instance of the class for the given tranche subordination levels.
+    def __init__(self, subordinations, control_mean=None, antithetic=False, weighted=False):
+        if weighted and (control_mean is not None or antithetic):
+            raise ValueError('Exception: Weighted simulations cannot use variance reduction.')
+        self._controlMean = control_mean
+        self._antithetic = antithetic
+        self._weighted = weighted
+        stats_class = WeightedStats if weighted else RunningStats
+        # These hold the observations, i.e. the single simulations or the averages of the pairs.
+        self._DIRR = {s: stats_class() for s in subordinations}
+        self._AL = {s: stats_class() for s in subordinations}
+        # These hold the single simulations.
+        self._simDIRR = {s: stats_class() for s in subordinations}
+        self._simAL = {s: stats_class() for s in subordinations}
+        # These hold the control variate of the observations and its covariance with the results.
+        self._control = RunningStats()
+        self._DIRRCov = {s: RunningCovariance() for s in subordinations}
+        self._ALCov = {s: RunningCovariance() for s in subordinations}
+        self._invalidCount = 0
+
+    # This adds the result of one simulation, a dict of (DIRR, AL) tuples keyed by subordination,
+    # along with its control variate and its weight if there are any.
+    def addResult(self, single_res, control=None, weight=1.0):
+        if self._antithetic:
+            raise ValueError('Exception: Antithetic simulations must be added in pairs.')
+        if any(single_res[s][1] is None for s in self._AL):
+            self._invalidCount += 1
+            return
+        self._addSimulation(single_res, weight)
+        self._addObservation({s: single_res[s][0] for s in self._AL},
+                             {s: single_res[s][1] for s in self._AL}, control, weight)
+
+    # This adds the results of a pair of antithetic simulations, along with their control
+    # variates if there are any. If either simulation is invalid, both are counted as invalid.
+    def addPair(self, res_1, res_2, control_1=None, control_2=None):
+        if any(res[s][1] is None for res in (res_1, res_2) for s in self._AL):
+            self._invalidCount += 2
+            return
+        self._addSimulation(res_1)
+        self._addSimulation(res_2)
+        self._addObservation({s: (res_1[s][0] + res_2[s][0]) / 2 for s in self._AL},
+                             {s: (res_1[s][1] + res_2[s][1]) / 2 for s in self._AL},
+                             None if control_1 is None else (control_1 + control_2) / 2)
+
+    # This adds a valid simulation to the statistics of the single simulations.
+    def _addSimulation(self, single_res, weight=1.0):
+        # The weight is only passed on to weighted statistics.
+        weight_args = (weight,) if self._weighted else ()
+        for s in self._AL:
+            self._simDIRR[s].add(single_res[s][0], *weight_args)
+            self._simAL[s].add(single_res[s][1], *weight_args)
+
+    # This adds one observation, given its DIRR and AL keyed by subordination.
+    def _addObservation(self, DIRR, AL, control, weight=1.0):
+        weight_args = (weight,) if self._weighted else ()
+        for s in self._AL:
+            self._DIRR[s].add(DIRR[s], *weight_args)
+            self._AL[s].add(AL[s], *weight_args)
+        if self._controlMean is not None:
+            self._control.add(control)
+            for s in self._AL:
+                self._DIRRCov[s].add(control, DIRR[s])
+                self._ALCov[s].add(control, AL[s])
+
+    # This adds the statistics of another SimulationStats object to this one.
+    def merge(self, other):
+        for s in self._AL:
+            self._DIRR[s].merge(other._DIRR[s])
+            self._AL[s].merge(other._AL[s])
+            self._simDIRR[s].merge(other._simDIRR[s])
+            self._simAL[s].merge(other._simAL[s])
+            self._DIRRCov[s].merge(other._DIRRCov[s])
+            self._ALCov[s].merge(other._ALCov[s])
+        self._control.merge(other._control)
+        self._invalidCount += other._invalidCount
+
+    # This returns the number of valid simulations.
+    @property
+    def validCount(self):
+        return min(stats.count for stats in self._simAL.values())
+
+    @property
+    def invalidCount(self):
+        return self._invalidCount
+
+    # This returns the total number of simulations.
+    @property
+    def count(self):
+        return self.validCount + self._invalidCount
+
+    # This returns the effective sample size of the valid simulations, which is the number of valid
+    # simulations unless they are weighted.
+    @property
+    def effectiveCount(self):
+        if not self._weighted:
+            return self.validCount
+        return min(stats.effectiveCount for stats in self._simAL.values())
+
+    # This returns the RunningStats of the DIRR of a tranche.
+    def DIRR(self, subordination):
+        return self._DIRR[subordination]
+
+    # This returns the RunningStats of the AL of a tranche.
+    def AL(self, subordination):
+        return self._AL[subordination]
+
+    # This returns the average of the observations, adjusted with the control variate if there is
+    # one. The adjustment uses the regression coefficient of the observations on the control.
+    def _estimate(self, stats, cov):
+        if self._controlMean is None or self._control.variance == 0:
+            return stats.mean
+        return stats.mean - cov.covariance / self._control.variance * \
+            (self._control.mean - self._controlMean)
+
+    # This returns the standard error of _estimate(). The control variate takes out the part of
+    # the variance that is explained by it.
+    def _stdError(self, stats, cov):
+        variance = stats.variance
+        if self._controlMean is None or self._control.variance == 0 or variance == 0:
+            return stats.stdError
+        variance *= 1 - min(1.0, cov.covariance ** 2 / (self._control.variance * variance))
+        return math.sqrt(variance / stats.count)
+
+    # This returns the ratio of the variance of plain Monte Carlo over the same number of
+    # simulations to the variance achieved.
+    def _varianceRatio(self, sim_stats, stats, cov):
+        return varianceRatio(sim_stats, self._stdError(stats, cov))
+
+    # This returns a dict of the RunningStats, or WeightedStats, of the (DIRR, AL) of the single
+    # simulations keyed by subordination.
+    def simulationStats(self):
+        return {s: (self._simDIRR[s], self._simAL[s]) for s in self._AL}
+
+    # This returns a dict of (average DIRR, average AL) tuples keyed by subordination.
+    def averages(self):
+        return {s: (self._estimate(self._DIRR[s], self._DIRRCov[s]),
+                    self._estimate(self._AL[s], self._ALCov[s])) for s in self._AL}
+
+    # This returns a dict of the standard errors of (DIRR, AL) keyed by subordination.
+    def stdErrors(self):
+        return {s: (self._stdError(self._DIRR[s], self._DIRRCov[s]),
+                    self._stdError(self._AL[s], self._ALCov[s])) for s in self._AL}
+
+    # This returns a dict of the variance ratios of (DIRR, AL) keyed by subordination. A ratio of
+    # 4 means that plain Monte Carlo would need 4 times as many simulations for the same precision.
+    def varianceRatios(self):
+        return {s: (self._varianceRatio(self._simDIRR[s], self._DIRR[s], self._DIRRCov[s]),
+                    self._varianceRatio(self._simAL[s], self._AL[s], self._ALCov[s]))
+                for s in self._AL}
+
+
+# This returns the ratio of the variance of plain Monte Carlo to the variance achieved, given the
+# RunningStats, or WeightedStats, of the single simulations and the standard error achieved. It
+# is nan if both variances are 0.
+def varianceRatio(sim_stats, std_error):
+    achieved = std_error ** 2
+    plain = sim_stats.variance / sim_stats.count if sim_stats.count > 0 else math.inf
+    if achieved == 0:
+        return math.nan if plain == 0 else math.inf
+    return plain / achieved
+
+
+# Each replicate is an independent randomization of the same low-discrepancy sequence, so the
+# averages of the replicates are independent and identically distributed. The overall average is
+# the average over the replicates, and its standard error comes from the spread between them.
+class ReplicatedStats(object):
+    # This initializes an instance of the class with one SimulationStats object per replicate.
+    def __init__(self, subordinations, num_replicates, control_mean=None, weighted=False):
+        self._subordinations = list(subordinations)
+        self._replicates = [SimulationStats(subordinations, control_mean, weighted=weighted)
+                            for r in range(num_replicates)]
+
+    # This returns the SimulationStats object of a replicate, to which results are added.
+    def replicate(self, replicate):
+        return self._replicates[replicate]
+
+    # This adds the statistics of another ReplicatedStats object to this one.
+    def merge(self, other):
+        for replicate, other_replicate in zip(self._replicates, other._replicates):
+            replicate.merge(other_replicate)
+
+    # This returns the number of valid simulations.
+    @property
+    def validCount(self):
+        return sum(replicate.validCount for replicate in self._replicates)
+
+    @property
+    def invalidCount(self):
+        return sum(replicate.invalidCount for replicate in self._replicates)
+
+    # This returns the total number of simulations.
+    @property
+    def count(self):
+        return self.validCount + self.invalidCount
+
+    # This returns the effective sample size of the valid simulations over all the replicates.
+    @property
+    def effectiveCount(self):
+        return sum(replicate.effectiveCount for replicate in self._replicates)
+
+    # This returns a dict keyed by subordination of the (DIRR, AL) RunningStats of the averages of
+    # the replicates. Replicates without any valid simulation are left out.
+    def _replicateStats(self):
+        stats = {s: (RunningStats(), RunningStats()) for s in self._subordinations}
+        for replicate in self._replicates:
+            if replicate.validCount == 0:
+                continue
+            for s, (DIRR, AL) in replicate.averages().items():
+                stats[s][0].add(DIRR)
+                stats[s][1].add(AL)
+        return stats
+
+    # This returns a dict of (average DIRR, average AL) tuples keyed by subordination.
+    def averages(self):
+        return {s: (DIRR.mean, AL.mean) for s, (DIRR, AL) in self._replicateStats().items()}
+
+    # This returns a dict of the standard errors of (DIRR, AL) keyed by subordination. At least
+    # two replicates are needed to estimate them.
+    def stdErrors(self):
+        return {s: (DIRR.stdError if DIRR.count > 1 else math.inf,
+                    AL.stdError if AL.count > 1 else math.inf)
+                for s, (DIRR, AL) in self._replicateStats().items()}
+
+    # This returns a dict of the variance ratios of (DIRR, AL) keyed by subordination.
+    def varianceRatios(self):
+        std_errors = self.stdErrors()
+        ratios = {}
+        for s in self._subordinations:
+            # This gathers the single simulations of all the replicates.
+            sim_DIRR, sim_AL = None, None
+            for replicate in self._replicates:
+                replicate_DIRR, replicate_AL = replicate.simulationStats()[s]
+                if sim_DIRR is None:
+                    sim_DIRR, sim_AL = type(replicate_DIRR)(), type(replicate_AL)()
+                sim_DIRR.merge(replicate_DIRR)
+                sim_AL.merge(replicate_AL)
+            ratios[s] = (varianceRatio(sim_DIRR, std_errors[s][0]),
+                         varianceRatio(sim_AL, std_errors[s][1]))
+        return ratios
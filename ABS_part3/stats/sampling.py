@@ -0,0 +1,123 @@
+'''
+This module contains random number generators used to reduce the variance of the Monte Carlo
+simulations. They provide the uniform() method of a numpy Generator that the loan pools draw from.
+'''
+from scipy.stats import qmc
+import numpy as np
+
+
+# This wraps a numpy Generator and returns 1 - u for every uniform random number u it draws. Two
+# simulations, one drawing from a Generator and the other from an AntitheticGenerator wrapping an
+# identical Generator, form an antithetic pair.
+class AntitheticGenerator(object):
+    # This initializes an instance of the class with the Generator to wrap.
+    def __init__(self, rng):
+        self._rng = rng
+
+    # This draws uniform random numbers over [0, 1) and returns their antithetic values.
+    def uniform(self, size=None):
+        return 1 - self._rng.uniform(size=size)
+
+
+# This provides the uniform() method of a numpy Generator for a single point of a quasi-random
+# sequence. The point holds one number per loan, so it can only be drawn all at once, which is
+# what the loan pools do when default periods are sampled in period 0 ('time' default sampling).
+class PointGenerator(object):
+    # This initializes an instance of the class with the point to return.
+    def __init__(self, point):
+        self._point = point
+
+    # This returns the point. Error is raised if the size does not match the point's dimension.
+    def uniform(self, size=None):
+        if size != len(self._point):
+            raise ValueError('Exception: Quasi-random points can only be drawn once per loan, '
+                             'which requires time default sampling.')
+        return self._point
+
+
+# This draws the random numbers of the simulations from randomized low-discrepancy sequences,
+# either scrambled Sobol ('sobol') or Latin hypercube ('lhs') points with one dimension per loan.
+# The simulations are spread over num_replicates independent randomizations: simulation i is point
+# i // num_replicates of replicate i % num_replicates, so every prefix of the simulations covers
+# all replicates evenly. The spread between the replicates' averages gives the error bars.
+# Sobol points are limited to _maxSobolDimension loans. Latin hypercube points work for any number
+# of loans, since each point is built when it is needed rather than stored.
+class QuasiRandomSampler(object):
+    # These are the supported low-discrepancy methods.
+    _methods = ('sobol', 'lhs')
+    # This is the largest dimension of the Sobol sequence supported by scipy.
+    _maxSobolDimension = 21201
+
+    # This initializes an instance of the class. num_points is the number of points in each
+    # replicate, which a Latin hypercube needs to know in advance.
+    def __init__(self, method, dimension, num_replicates, num_points):
+        # Error is raised if the method is not supported or the sizes are not positive.
+        if method not in self._methods:
+            raise ValueError('Exception: This is not a valid quasi-random sampling method.')
+        if dimension < 1 or num_replicates < 1 or num_points < 1:
+            raise ValueError('Exception: Sizes of quasi-random samples must be positive.')
+        if method == 'sobol' and dimension > self._maxSobolDimension:
+            raise ValueError('Exception: Sobol points support at most {0} loans, but the pool has '
+                             '{1}. Latin hypercube points can be used instead.'.format(
+                                 self._maxSobolDimension, dimension))
+        self._method = method
+        self._dimension = dimension
+        self._numReplicates = num_replicates
+        self._numPoints = num_points
+        # The Sobol engines, or the Latin hypercube permutations, are created the first time a
+        # replicate is used with a given seed. Only those of the last seed are kept.
+        self._seed = None
+        self._engines = {}
+
+    @property
+    def numReplicates(self):
+        return self._numReplicates
+
+    # This returns the replicate of the i-th simulation.
+    def replicateOf(self, i):
+        return i % self._numReplicates
+
+    # This returns the generator of the i-th simulation. The randomization of each replicate is
+    # derived from the seed, so results do not depend on how simulations are split.
+    def getGenerator(self, seed, i):
+        replicate, j = i % self._numReplicates, i // self._numReplicates
+        if j >= self._numPoints:
+            raise ValueError('Exception: The replicate has no point left.')
+        if seed != self._seed:
+            self._seed = seed
+            self._engines = {}
+        if replicate not in self._engines:
+            rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(replicate,)))
+            if self._method == 'sobol':
+                self._engines[replicate] = qmc.Sobol(self._dimension, scramble=True, seed=rng)
+            else:
+                self._engines[replicate] = self._latinHypercubePermutations(rng)
+        engine = self._engines[replicate]
+        if self._method == 'lhs':
+            # Point j falls in stratum (a * j + b) % num_points of every dimension, at a uniform
+            # random position within the stratum.
+            slope, offset = engine
+            rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(replicate, j)))
+            strata = (slope * j + offset) % self._numPoints
+            return PointGenerator((strata + rng.uniform(size=self._dimension)) / self._numPoints)
+        # The Sobol engine moves forward one point per draw, so it only needs to be moved when
+        # the simulations are not carried out in order.
+        if engine.num_generated != j:
+            engine.reset()
+            engine.fast_forward(j)
+        return PointGenerator(engine.random(1)[0])
+
+    # This draws the permutations of the strata of a Latin hypercube, one per dimension. Each is
+    # the map j -> (a * j + b) % num_points, with a coprime to num_points and b uniform, so only two
+    # numbers are kept per dimension instead of num_points. Since b is uniform and independent
+    # across dimensions, every point is still made of independent uniform random numbers, and
+    # every dimension still has exactly one point per stratum.
+    def _latinHypercubePermutations(self, rng):
+        slope = rng.integers(1, max(self._numPoints, 2), size=self._dimension)
+        # Slopes sharing a factor with num_points are drawn again until none is left.
+        invalid = np.flatnonzero(np.gcd(slope, self._numPoints) != 1)
+        while len(invalid) > 0:
+            slope[invalid] = rng.integers(1, max(self._numPoints, 2), size=len(invalid))
+            invalid = invalid[np.gcd(slope[invalid], self._numPoints) != 1]
+        offset = rng.integers(0, self._numPoints, size=self._dimension)
+        return slope, offset
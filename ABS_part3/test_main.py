@@ -0,0 +1,80 @@
+'''
+This module checks the waterfall metrics of many paths at once against those of one path at a time.
+It is run with python -m pytest from the ABS_part3 folder.
+'''
+from liability.tranche import StandardTranche
+from liability.securities import StructuredSecurities
+from loan.auto_loan import AutoLoan
+from loan.loan_pool import LoanPool
+from asset.cars import Car
+from main import payLiabilities, payLiabilitiesBatch, simulateAdaptive, simulateWaterfall
+import numpy as np
+
+
+# This returns num_paths asset paths of up to num_periods periods after period 0. Each period holds
+# principal due, interest due, recovery value, total amount paid, and remaining balance, although
+# only the first two are paid out. The first paths repay the whole notional of 10 ** 6, so that
+# the tranches are paid off, while the others fall short. The last path has no cash at all, so
+# none of its tranches has an IRR.
+def makeAssetPaths(rng, num_paths, num_periods):
+    asset_paths = []
+    for i in range(num_paths):
+        length = rng.integers(1, num_periods + 1)
+        principal = rng.uniform(0, 1, length)
+        repaid = 1.2 if i < num_paths // 2 else rng.uniform(0.3, 1)
+        principal *= repaid * 10 ** 6 / principal.sum()
+        interest = rng.uniform(0, 10 ** 4, length)
+        if i == num_paths - 1:
+            principal[:] = 0
+            interest[:] = 0
+        asset_path = [[0, 0, 0, 0, 10 ** 6]]
+        asset_path.extend([p, r, 0, p + r, 0] for p, r in zip(principal, interest))
+        asset_paths.append(asset_path)
+    return asset_paths
+
+
+# This checks that payLiabilitiesBatch() returns the same DIRR and AL for every tranche on every
+# path as payLiabilities() does, in both sequential and pro rata mode.
+def testBatchMetricsMatchMetricsOfEachPath():
+    rng = np.random.default_rng(22)
+    asset_paths = makeAssetPaths(rng, 30, 72)
+    for sequential in (True, False):
+        structured_deal = StructuredSecurities()
+        structured_deal.addTranche(StandardTranche(8 * 10 ** 5, 0.05, 'A'),
+                                   StandardTranche(2 * 10 ** 5, 0.08, 'B'))
+        structured_deal.sequential = sequential
+        batch_res = payLiabilitiesBatch(asset_paths, structured_deal)
+        for asset_path, batch_single_res in zip(asset_paths, batch_res):
+            single_res = payLiabilities(asset_path, structured_deal)
+            assert single_res.keys() == batch_single_res.keys()
+            for subordination, (tranche_DIRR, AL) in single_res.items():
+                batch_DIRR, batch_AL = batch_single_res[subordination]
+                assert np.isclose(batch_DIRR, tranche_DIRR, rtol=10 ** -10, atol=10 ** -12,
+                                  equal_nan=True)
+                assert (batch_AL is None) == (AL is None)
+                assert AL is None or np.isclose(batch_AL, AL, rtol=10 ** -12)
+        # The path without any cash leaves every tranche without an IRR.
+        assert all(np.isnan(tranche_DIRR) for tranche_DIRR, AL in batch_res[-1].values())
+
+
+# This checks that the adaptive inner loop stops after the same chunk whatever the batch size, also
+# when it stops in the middle of a batch.
+def testAdaptiveStopDoesNotDependOnBatchSize():
+    rng = np.random.default_rng(14)
+    loaded_pool = LoanPool([AutoLoan(Car(rng.uniform(10 ** 4, 5 * 10 ** 4)),
+                                     rng.uniform(5000, 40000), rng.uniform(0.02, 0.1),
+                                     float(rng.integers(12, 72))) for i in range(30)])
+    loaded_pool.defaultSampling = 'time'
+    total_principal = loaded_pool.totalPrincipal() * 0.95
+    structured_deal = StructuredSecurities()
+    structured_deal.addTranche(StandardTranche(total_principal * 0.8, 0.05, 'A'),
+                               StandardTranche(total_principal * 0.2, 0.08, 'B'))
+    simulate = lambda start, stop: simulateWaterfall(loaded_pool, structured_deal, stop, None, 5,
+                                                     start, chunk_size=20, by_chunk=True)
+    for target_std_error in ((1, 0.3), (1, 0.1)):
+        results = []
+        for batch_size in (20, 60, 100):
+            stats = simulateAdaptive(simulate, structured_deal, 600, target_std_error, batch_size)
+            results.append((stats.count, stats.averages(), stats.stdErrors()))
+        assert results[0] == results[1] == results[2]
+        assert results[0][0] % 60
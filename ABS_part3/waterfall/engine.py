@@ -0,0 +1,25 @@
+'''
+This module contains the runWaterfall function, which runs the liability side of the waterfall over
+an asset path and reports every period to a sink.
+'''
+from waterfall.sinks import WaterfallSink
+
+
+# This runs the waterfall of the structured deal over asset_path, which holds the asset-side
+# waterfall of every period from period 0 on: principal due, interest due, recovery value, total
+# amount paid, and remaining balance. Nothing is paid in period 0. The sink is opened with the deal,
+# receives every period once it has been paid, and is closed at the end. Without a sink, nothing
+# is reported. The tranches are not reset, so that their metrics can still be calculated.
+def runWaterfall(asset_path, structured_deal, sink=None):
+    if sink is None:
+        sink = WaterfallSink()
+    sink.open(structured_deal)
+    for period, asset_waterfall in enumerate(asset_path):
+        if period != 0:
+            # This increases the period on the liability side by 1.
+            structured_deal.increaseTimePeriodForAll()
+            # Making payments to the liabilities requires information about the interest
+            # payments and principal payments from the assets.
+            structured_deal.makePayments(asset_waterfall[1], asset_waterfall[0])
+        sink.addPeriod(period, asset_waterfall, structured_deal)
+    sink.close()
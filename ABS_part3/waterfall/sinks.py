@@ -0,0 +1,141 @@
+'''
+This module contains the sinks that runWaterfall() reports the periods of the waterfall to. The
+WaterfallSink base class reports nothing. The RecordingSink class keeps the periods as they come,
+and its subclasses write them out once the waterfall is completed, as CSV files or as a numpy file
+with one array per column.
+'''
+import numpy as np
+import os
+import logging
+
+
+# This is the WaterfallSink base class. Its methods do nothing, so it can be used when only the
+# metrics of the waterfall are needed, e.g. in Monte Carlo simulations.
+class WaterfallSink(object):
+    # This is called before period 0 with the structured deal.
+    def open(self, structured_deal):
+        pass
+
+    # This is called after every period with the asset-side waterfall of the period and the
+    # structured deal that has just been paid.
+    def addPeriod(self, period, asset_waterfall, structured_deal):
+        pass
+
+    # This is called once the waterfall is completed.
+    def close(self):
+        pass
+
+
+# This keeps the asset-side and liability-side waterfall of every period. Nothing is formatted
+# while the waterfall runs; the records are only turned into tables when they are written out.
+# The liability side is taken from StructuredSecurities.getWaterfall().
+class RecordingSink(WaterfallSink):
+    # These are the columns of the asset side, after the period.
+    _assetColumns = ('Principal', 'Interest', 'Recoveries', 'Total', 'Balance')
+    # These are the columns of each tranche on the liability side, after the period. The cash
+    # reserve comes after all the tranches.
+    _trancheColumns = ('Interest Due', 'Interest Paid', 'Interest Shortfall', 'Principal Due',
+                       'Principal Paid', 'Principal Shortfall', 'Balance', 'Cash Flow')
+
+    # This initializes an instance of the class.
+    def __init__(self):
+        self._subordinations = []
+        self._assetRecords = []
+        self._liabilityRecords = []
+
+    # This clears the records and notes the tranches of the structured deal.
+    def open(self, structured_deal):
+        self._subordinations = [tranche.subordination for tranche in structured_deal]
+        self._assetRecords = []
+        self._liabilityRecords = []
+
+    # This records the period as it is.
+    def addPeriod(self, period, asset_waterfall, structured_deal):
+        self._assetRecords.append(tuple(asset_waterfall))
+        self._liabilityRecords.append(structured_deal.getWaterfall())
+
+    # This returns the names of the asset-side columns, starting with the period.
+    def assetColumns(self):
+        return ['Period'] + list(self._assetColumns)
+
+    # This returns the names of the liability-side columns, starting with the period. Each tranche
+    # column is labelled with the tranche's subordination.
+    def liabilityColumns(self):
+        return (['Period'] + ['{0} {1}'.format(subordination, column)
+                              for subordination in self._subordinations
+                              for column in self._trancheColumns] + ['Cash Reserve'])
+
+    # This returns the asset side as a 2-D array with one row per period and the columns given by
+    # assetColumns().
+    def assetTable(self):
+        table = np.zeros((len(self._assetRecords), len(self._assetColumns) + 1))
+        table[:, 0] = np.arange(len(self._assetRecords))
+        if self._assetRecords:
+            table[:, 1:] = self._assetRecords
+        return table
+
+    # This returns the liability side as a 2-D array with one row per period and the columns given
+    # by liabilityColumns().
+    def liabilityTable(self):
+        table = np.zeros((len(self._liabilityRecords),
+                          len(self._subordinations) * len(self._trancheColumns) + 2))
+        table[:, 0] = np.arange(len(self._liabilityRecords))
+        for period, (liability_waterfall, cash_reserve) in enumerate(self._liabilityRecords):
+            table[period, 1:-1] = np.ravel(liability_waterfall)
+            table[period, -1] = cash_reserve
+        return table
+
+
+# This writes the waterfall to two CSV files, one for the asset side and one for the liability
+# side. The lines are formatted and written all at once when the sink is closed.
+class CSVSink(RecordingSink):
+    # This initializes an instance of the class with the paths of the output files, which are
+    # located at the current working directory by default.
+    def __init__(self, assets_file_path=None, liabilities_file_path=None):
+        super(CSVSink, self).__init__()
+        self._assetsFilePath = assets_file_path or os.path.join(os.getcwd(), 'Assets.csv')
+        self._liabilitiesFilePath = \
+            liabilities_file_path or os.path.join(os.getcwd(), 'Liabilities.csv')
+
+    # This writes the two output files. Every line ends with a comma, except for the header of the
+    # liability-side file. The values are written from the records rather than from the tables, so
+    # that each one keeps its own type, e.g. an integer 0 is written as 0 rather than 0.0. The
+    # loans report amounts of exactly 0 as the integer 0, so the zeros of the asset side are
+    # written as 0 even when the asset path is a float array, as with 'time' default sampling.
+    def close(self):
+        asset_lines = ['{0},\n'.format(','.join(self.assetColumns()))]
+        asset_lines.extend(self._formatLine(period, [0 if value == 0 else value
+                                                     for value in asset_waterfall])
+                           for period, asset_waterfall in enumerate(self._assetRecords))
+        liability_lines = ['{0}\n'.format(','.join(self.liabilityColumns()))]
+        for period, (liability_waterfall, cash_reserve) in enumerate(self._liabilityRecords):
+            values = [value for tranche in liability_waterfall for value in tranche]
+            liability_lines.append(self._formatLine(period, values + [cash_reserve]))
+        with open(self._assetsFilePath, 'w') as afp:
+            afp.write(''.join(asset_lines))
+        with open(self._liabilitiesFilePath, 'w') as lfp:
+            lfp.write(''.join(liability_lines))
+        logging.info('The waterfall has been written to {0} and {1}.'.format(
+            self._assetsFilePath, self._liabilitiesFilePath))
+
+    # This formats the values of a period as a line of a CSV file, starting with the period.
+    @staticmethod
+    def _formatLine(period, values):
+        return '{0},{1},\n'.format(period, ','.join(map(str, values)))
+
+
+# This writes the waterfall to a single .npz file with one array per column, named as in the CSV
+# files. The asset-side columns come first, and the period is only stored once.
+class ColumnarSink(RecordingSink):
+    # This initializes an instance of the class with the path of the output file, which is
+    # located at the current working directory by default.
+    def __init__(self, file_path=None):
+        super(ColumnarSink, self).__init__()
+        self._filePath = file_path or os.path.join(os.getcwd(), 'Waterfall.npz')
+
+    # This writes the output file.
+    def close(self):
+        columns = dict(zip(self.assetColumns(), self.assetTable().T))
+        columns.update(zip(self.liabilityColumns()[1:], self.liabilityTable()[:, 1:].T))
+        np.savez(self._filePath, **columns)
+        logging.info('The waterfall has been written to {0}.'.format(self._filePath))
@@ -0,0 +1,75 @@
+'''
+This module checks the files written by CSVSink against the golden files in the golden folder. It is
+run with python -m pytest from the ABS_part3 folder.
+'''
+from loan.auto_loan import AutoLoan
+from loan.loan_pool import LoanPool
+from loan.array_loan_pool import ArrayLoanPool
+from asset.cars import Car
+from liability.tranche import StandardTranche
+from liability.securities import StructuredSecurities
+from main import simulateAssets, payLiabilities
+from waterfall.sinks import CSVSink
+import numpy as np
+import os
+
+
+# This is the folder of the golden files.
+_goldenFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+
+
+# This returns four auto loans of round amounts, so that their total is the same however it is
+# added up. The amounts are floats, as when they are read from Loans.csv.
+def makeLoans():
+    return [AutoLoan(Car(20000.0), 15000.0, 0.05, 24.0),
+            AutoLoan(Car(30000.0), 25000.0, 0.07, 36.0),
+            AutoLoan(Car(15000.0), 9000.0, 0.04, 12.0),
+            AutoLoan(Car(40000.0), 32000.0, 0.06, 48.0)]
+
+
+# This returns a structured deal of two tranches over the loans.
+def makeDeal(loaded_pool):
+    total_principal = loaded_pool.totalPrincipal() * 0.95
+    structured_deal = StructuredSecurities()
+    structured_deal.addTranche(StandardTranche(total_principal * 0.8, 0.05, 'A'),
+                               StandardTranche(total_principal * 0.2, 0.08, 'B'))
+    structured_deal.sequential = True
+    return structured_deal
+
+
+# This runs the waterfall of one simulation, writes it with a CSVSink to folder, and returns the
+# lines of the two files.
+def writeWaterfall(loaded_pool, folder, seed):
+    assets_file_path = os.path.join(str(folder), 'Assets.csv')
+    liabilities_file_path = os.path.join(str(folder), 'Liabilities.csv')
+    payLiabilities(simulateAssets(loaded_pool, np.random.default_rng(seed)),
+                   makeDeal(loaded_pool), CSVSink(assets_file_path, liabilities_file_path))
+    return readLines(assets_file_path), readLines(liabilities_file_path)
+
+
+# This returns the lines of a file, whatever its line endings.
+def readLines(file_path):
+    with open(file_path) as fp:
+        return fp.read().splitlines()
+
+
+# This checks that a simulation with 'time' default sampling, which main() uses, is written as in
+# the golden files. Its asset path is a float array, but the zeros of the asset side, such as
+# those of period 0, are still written as 0.
+def testCSVSinkMatchesGoldenFiles(tmp_path):
+    loaded_pool = ArrayLoanPool.fromLoans(makeLoans())
+    loaded_pool.defaultSampling = 'time'
+    asset_lines, liability_lines = writeWaterfall(loaded_pool, tmp_path, 25)
+    assert asset_lines == readLines(os.path.join(_goldenFolder, 'Assets.csv'))
+    assert liability_lines == readLines(os.path.join(_goldenFolder, 'Liabilities.csv'))
+    assert asset_lines[1] == '0,0,0,0,0,81000.0,'
+
+
+# This checks that period 0, which does not depend on the defaults, is written the same with
+# 'period' default sampling, whose asset path holds the values as the loans report them.
+def testCSVSinkPeriodZeroMatchesPeriodSampling(tmp_path):
+    asset_lines, liability_lines = writeWaterfall(LoanPool(makeLoans()), tmp_path, 25)
+    golden_asset_lines = readLines(os.path.join(_goldenFolder, 'Assets.csv'))
+    golden_liability_lines = readLines(os.path.join(_goldenFolder, 'Liabilities.csv'))
+    assert asset_lines[:2] == golden_asset_lines[:2]
+    assert liability_lines[:2] == golden_liability_lines[:2]
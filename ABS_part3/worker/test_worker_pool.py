@@ -0,0 +1,46 @@
+'''
+This module checks that a WorkerPool whose processes are terminated does not keep the main process
+from exiting, even when work units are still waiting in the queue. It is run with python -m pytest
+from the ABS_part3 folder.
+'''
+import os
+import signal
+import subprocess
+import sys
+import time
+
+
+# This is the target of the processes, which never takes a work unit, so that those submitted stay
+# in the queue.
+def ignoreWorkUnits(iQueue, oQueue):
+    time.sleep(60)
+
+
+# This is run in a separate process. It submits work units far larger than the pipe of the queue
+# can hold and waits to be interrupted, which terminates the processes.
+_interruptedRun = '''
+from worker.worker_pool import WorkerPool
+from worker.test_worker_pool import ignoreWorkUnits
+import time
+if __name__ == '__main__':
+    with WorkerPool(ignoreWorkUnits, 2) as workers:
+        for i in range(4):
+            workers.submit(bytes(300000), i % 2)
+        print('submitted', flush=True)
+        time.sleep(60)
+'''
+
+
+# This checks that a run interrupted while its work units are waiting in the queue exits right
+# away.
+def testInterruptedRunExits():
+    run = subprocess.Popen([sys.executable, '-c', _interruptedRun], stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.dirname(
+                               os.path.abspath(__file__))))
+    try:
+        assert run.stdout.readline().strip() == b'submitted'
+        run.send_signal(signal.SIGINT)
+        run.wait(timeout=20)
+    finally:
+        run.kill()
+    assert b'KeyboardInterrupt' in run.stderr.read()
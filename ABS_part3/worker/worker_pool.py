@@ -0,0 +1,86 @@
+'''
+This module contains the WorkerPool class, which keeps a set of long-lived processes that carry
+out work units sent to them through their own queues.
+'''
+import multiprocessing
+import logging
+import queue
+
+
+# The processes are created once, and whatever they need for every work unit is handed to them at
+# start-up. Afterwards, only small work units and their results go through the queues. Each process
+# has its own input queue, so that a work unit can be sent to the process that already holds what
+# it needs, while all the results go through one output queue.
+class WorkerPool(object):
+    # This initializes an instance of the class and starts the processes. Each process executes
+    # target(iQueue, oQueue, *args), which should keep taking work units from its iQueue until it
+    # receives None.
+    def __init__(self, target, num_processes, *args):
+        # These are the input queues that feed work units to each process.
+        self._iQueues = []
+        # This is the output queue that holds the results.
+        self._oQueue = multiprocessing.Queue()
+        # This list holds the processes' handles, so they can be stopped later.
+        self._processHandles = []
+        for i in range(num_processes):
+            self._iQueues.append(multiprocessing.Queue())
+            p = multiprocessing.Process(target=target, args=(self._iQueues[i], self._oQueue) + args)
+            # Daemon processes are terminated if the main process exits unexpectedly.
+            p.daemon = True
+            self._processHandles.append(p)
+            p.start()
+        logging.debug('{0} worker processes have been started.'.format(num_processes))
+
+    # This is entry point for 'with' statement.
+    def __enter__(self):
+        return self
+
+    # This makes sure the processes are stopped when leaving the 'with' statement. If an exception
+    # was raised, they are terminated without waiting for the remaining work units.
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    # This returns the number of processes.
+    def __len__(self):
+        return len(self._processHandles)
+
+    # This sends one work unit to the process of the given index.
+    def submit(self, work_unit, process_index):
+        self._iQueues[process_index].put(work_unit)
+
+    # This is blocked until a process provides a result, which is then returned. Error is raised
+    # if a process stops before every result has been provided, which would otherwise block forever.
+    def getResult(self):
+        while True:
+            try:
+                return self._oQueue.get(timeout=1)
+            except queue.Empty:
+                if not all(p.is_alive() for p in self._processHandles):
+                    logging.error('A worker process has stopped unexpectedly.')
+                    raise RuntimeError('Exception: A worker process has stopped unexpectedly.')
+
+    # This tells every process to stop and waits for them to finish.
+    def close(self):
+        for i in range(len(self._processHandles)):
+            self._iQueues[i].put(None)
+        for p in self._processHandles:
+            p.join()
+        self._processHandles = []
+        logging.debug('The worker processes have been stopped.')
+
+    # This stops every process right away, dropping any work units and results left in the queues.
+    # The queues are closed without waiting for their feeder threads to flush the work units that
+    # nobody will take any more, which would otherwise block the main process when it exits.
+    def terminate(self):
+        for p in self._processHandles:
+            p.terminate()
+        for p in self._processHandles:
+            p.join()
+        self._processHandles = []
+        for q in self._iQueues + [self._oQueue]:
+            q.cancel_join_thread()
+            q.close()
+        logging.debug('The worker processes have been terminated.')